@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Name: amitool-bench
+
+Synopsis: Offline benchmarks for amitool.py. Runs the search and orphan scan code paths against an in-process fake
+EC2 backend seeded with synthetic images and snapshots, and reports wall time and API call counts per scenario.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import fnmatch
+from collections import Counter
+from datetime import datetime, timedelta
+from argparse import RawTextHelpFormatter
+
+import amitool
+
+class record(object):
+    """
+    Attribute bag standing in for boto's Image, BlockDeviceType, Snapshot and Region objects.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class fake_ec2(object):
+    """
+    In-process EC2 backend implementing the calls amitool makes. Every call sleeps for the configured latency and is
+    counted in self.calls.
+    """
+    def __init__(self, snapshots, devices=2, orphan_ratio=0.1, latency=0.05, seed=42):
+        """
+        :param snapshots: Number of snapshots to create.
+        :param devices: Block devices (snapshots) per image.
+        :param orphan_ratio: Fraction of snapshots whose image has been deregistered.
+        :param latency: Seconds added to every API call.
+        """
+        self.region = record(name='bench-1')
+        self.latency = latency
+        self.calls = Counter()
+        self.images = {}
+        self.snapshots = {}
+
+        rng = random.Random(seed)
+        start = datetime(2014, 1, 1)
+        clusters = ['cluster{0:03d}'.format(i) for i in range(max(1, snapshots / 200))]
+        image_count = snapshots / devices
+
+        for i in range(image_count):
+            ami_id = 'ami-{0:08x}'.format(i)
+            created = start + timedelta(minutes=i)
+            cluster = rng.choice(clusters)
+            mapping = {}
+            for d in range(devices):
+                snap_id = 'snap-{0:08x}'.format(i * devices + d)
+                device = '/dev/sd' + chr(ord('a') + d) + ('1' if d == 0 else '')
+                mapping[device] = record(snapshot_id=snap_id)
+                self.snapshots[snap_id] = record(id=snap_id, volume_size=rng.choice([8, 20, 50, 100]),
+                                                 start_time=created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                                 description='Created by CreateImage(i-{0:08x}) for {1} from '
+                                                             'vol-{2:08x}'.format(i, ami_id, i * devices + d))
+
+            if rng.random() >= orphan_ratio:
+                self.images[ami_id] = record(id=ami_id, state='available', root_device_name='/dev/sda1',
+                                             name='{0}-autoscale-{1}'.format(cluster,
+                                                                             created.strftime('%Y-%m-%d-%H-%M-%S')),
+                                             description='Autoscale image for ' + cluster,
+                                             block_device_mapping=mapping)
+
+    def _call(self, name):
+        self.calls[name] += 1
+        time.sleep(self.latency)
+
+    def _matches(self, obj, filters):
+        for field, values in (filters or {}).items():
+            if not isinstance(values, list):
+                values = [values]
+            attribute = {'image-id': 'id', 'snapshot-id': 'id', 'start-time': 'start_time'}.get(field, field)
+            value = str(getattr(obj, attribute))
+            if not any(fnmatch.fnmatchcase(value, pattern) for pattern in values):
+                return False
+        return True
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self._call('DescribeImages')
+        images = self.images.values()
+        if image_ids:
+            images = [self.images[ami_id] for ami_id in image_ids]
+        return [image for image in images if self._matches(image, filters)]
+
+    def get_image(self, image_id):
+        self._call('DescribeImages')
+        return self.images.get(image_id)
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        self._call('DescribeSnapshots')
+        snapshots = self.snapshots.values()
+        if snapshot_ids:
+            snapshots = [self.snapshots[snap_id] for snap_id in snapshot_ids]
+        return [snapshot for snapshot in snapshots if self._matches(snapshot, filters)]
+
+    def deregister_image(self, image_id, delete_snapshot=False):
+        self._call('DeregisterImage')
+        self.images.pop(image_id, None)
+
+    def delete_snapshot(self, snapshot_id):
+        self._call('DeleteSnapshot')
+        self.snapshots.pop(snapshot_id, None)
+
+def run(name, ec2, func):
+    """
+    Times func with stdout silenced and returns (name, seconds, api calls).
+    """
+    ec2.calls.clear()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return name, elapsed, sum(ec2.calls.values())
+
+def benchmark(snapshots, devices, latency):
+    """
+    Runs every scenario against a backend seeded with the given number of snapshots.
+    :return: List of (scenario, seconds, api calls) tuples.
+    """
+    ec2 = fake_ec2(snapshots, devices=devices, latency=latency)
+    narrow = 'cluster000-autoscale-2014-01-01-0[01]'
+    results = []
+
+    api = amitool.ami(cache=False, connection=ec2)
+    results.append(run('search .* (no cache)', ec2, lambda: api.search('.*')))
+    results.append(run('search narrow (no cache)', ec2, lambda: api.search(narrow)))
+    results.append(run('find_orphans (no cache)', ec2, lambda: api.find_orphans()))
+
+    cache_dir = tempfile.mkdtemp(prefix='amitool-bench-')
+    try:
+        api = amitool.ami(cache=False, connection=ec2)
+        api.inventory = amitool.inventory(ec2, path=os.path.join(cache_dir, 'inventory.db'), account='bench')
+        results.append(run('cache full refresh', ec2, lambda: api._cached()))
+        results.append(run('search .* (cached)', ec2, lambda: api.search('.*')))
+        results.append(run('search narrow (cached)', ec2, lambda: api.search(narrow)))
+        results.append(run('find_orphans (cached)', ec2, lambda: api.find_orphans()))
+    finally:
+        api.inventory.db.close()
+        shutil.rmtree(cache_dir)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for amitool.py against a synthetic EC2 backend.',
+                                     formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--snapshots', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Snapshot counts to benchmark.')
+    parser.add_argument('--devices', type=int, default=2, help='Block devices per image.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of latency added to every API call.')
+    args = vars(parser.parse_args())
+
+    print "{0:>10}  {1:<28} {2:>10} {3:>10}".format('snapshots', 'scenario', 'seconds', 'api calls')
+    print "-" * 62
+    for snapshots in args['snapshots']:
+        for name, elapsed, calls in benchmark(snapshots, args['devices'], args['latency']):
+            print "{0:>10}  {1:<28} {2:>10.3f} {3:>10}".format(snapshots, name, elapsed, calls)
+
+if __name__ == "__main__":
+    main()
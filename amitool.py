@@ -2,23 +2,468 @@
 """
 amitool.py provides a toolset for common AMI operations.
 
-Currently only connects to the region from which it is run.
+Connects to the region from which it is run unless search is given --regions.
 """
 
 import sys
+import os
 import re
+import json
+import time
+import random
+import heapq
+import sqlite3
+import threading
 import boto
+import boto.ec2
+import boto.ec2.autoscale
 import argparse
 from argparse import RawTextHelpFormatter
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+# EC2 error codes that mean "slow down and try again".
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling')
+
+class rate_limiter(object):
+    """
+    Token bucket shared by worker threads. The rate is halved whenever EC2 throttles us and
+    creeps back up towards the starting rate as calls succeed.
+    """
+    def __init__(self, rate, min_rate=0.5):
+        self.rate = float(rate)
+        self.max_rate = float(rate)
+        self.min_rate = min_rate
+        self.tokens = 1.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+# Local inventory cache settings.
+CACHE_PATH = os.path.expanduser('~/.amitool/inventory.db')
+CACHE_TTL = 900
+# Incremental refreshes older than this many days fall back to a full refresh.
+CACHE_MAX_INCREMENTAL_DAYS = 31
+# Incremental refreshes never see snapshots deleted outside amitool, so a full refresh is forced at least this often.
+CACHE_FULL_REFRESH = 86400
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS refreshes (region TEXT, account TEXT, refreshed REAL, full_refreshed REAL,
+                                      PRIMARY KEY (region, account));
+CREATE TABLE IF NOT EXISTS images (region TEXT, account TEXT, id TEXT, name TEXT, description TEXT,
+                                   root_device_name TEXT, PRIMARY KEY (region, account, id));
+CREATE TABLE IF NOT EXISTS image_devices (region TEXT, account TEXT, image_id TEXT, device TEXT, snapshot_id TEXT);
+CREATE INDEX IF NOT EXISTS image_devices_image ON image_devices (region, account, image_id);
+CREATE TABLE IF NOT EXISTS snapshots (region TEXT, account TEXT, id TEXT, description TEXT, volume_size INTEGER,
+                                      start_time TEXT, PRIMARY KEY (region, account, id));
+"""
+
+# Lightweight stand-ins for boto's Image, BlockDeviceType and Snapshot when answering from the cache.
+image_record = namedtuple('image_record', 'id name description root_device_name block_device_mapping')
+device_record = namedtuple('device_record', 'snapshot_id')
+snapshot_record = namedtuple('snapshot_record', 'id description volume_size start_time')
+
+def get_account_id(ec2):
+    """
+    Returns the id of the account whose credentials the connection uses, or None if it can't be determined.
+    DescribeSecurityGroups only returns the caller's own groups, so the owner of a default group is that account.
+    """
+    try:
+        groups = ec2.get_all_security_groups(filters={'group-name': 'default'})
+        if groups and groups[0].owner_id:
+            return groups[0].owner_id
+    except Exception:
+        pass
+
+    # IAM users can also read their own ARN: arn:aws:iam::<account>:user/<name>
+    try:
+        arn = boto.connect_iam().get_user()['get_user_response']['get_user_result']['user']['arn']
+        return arn.split(':')[4]
+    except Exception:
+        return None
+
+class inventory(object):
+    """
+    On-disk SQLite copy of the self-owned image and snapshot lists, keyed by region and account.
+
+    The cache is answered from directly while it is younger than the TTL. Past the TTL, snapshots are refreshed
+    incrementally (only days since the newest cached start_time) and images are re-listed. Once the last full
+    refresh is older than CACHE_FULL_REFRESH everything is re-downloaded, dropping snapshots deleted elsewhere.
+    """
+    def __init__(self, ec2, path=CACHE_PATH, ttl=CACHE_TTL, account=None):
+        """
+        :param account: Id of the account the connection's credentials belong to. Looked up when not given.
+        """
+        self.ec2 = ec2
+        self.ttl = ttl
+        self.region = ec2.region.name
+        self.account = account or get_account_id(ec2)
+        if not self.account:
+            raise ValueError("Unable to determine the account for the inventory cache")
+
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another region thread created it first.
+                pass
+        # Region scans share the file from several threads; each inventory connection is only used serially.
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(CACHE_SCHEMA)
+        # Caches created before full refreshes were tracked lack the column; they get a full refresh next time.
+        if 'full_refreshed' not in [column[1] for column in self.db.execute('PRAGMA table_info(refreshes)')]:
+            self.db.execute('ALTER TABLE refreshes ADD COLUMN full_refreshed REAL')
+
+    def refresh(self, force=False):
+        """
+        Brings the cache up to date.
+        :param force: Discard the cache and re-download everything.
+        """
+        row = self.db.execute('SELECT refreshed, full_refreshed FROM refreshes WHERE region=? AND account=?',
+                              (self.region, self.account)).fetchone()
+
+        if force or row is None or row[1] is None or time.time() - row[1] > CACHE_FULL_REFRESH:
+            self._full_refresh()
+        elif time.time() - row[0] > self.ttl:
+            self._incremental_refresh()
+
+    def _full_refresh(self):
+        print >>sys.stderr, "Refreshing inventory cache for {0}".format(self.region)
+        # Snapshots are listed before images so every listed snapshot's image is already registered.
+        snapshots = self.ec2.get_all_snapshots(owner='self')
+        images = self.ec2.get_all_images(owners='self')
+
+        with self.db:
+            self.db.execute('DELETE FROM snapshots WHERE region=? AND account=?', (self.region, self.account))
+            self._store_snapshots(snapshots)
+            self._store_images(images)
+            self._mark_refreshed(full=True)
+
+    def _incremental_refresh(self):
+        newest = self.db.execute('SELECT MAX(start_time) FROM snapshots WHERE region=? AND account=?',
+                                 (self.region, self.account)).fetchone()[0]
+        if not newest:
+            return self._full_refresh()
+
+        # DescribeSnapshots has no "newer than" filter, so match every day since the newest cached snapshot.
+        day = datetime.strptime(newest[:10], '%Y-%m-%d')
+        today = datetime.utcnow()
+        if (today - day).days > CACHE_MAX_INCREMENTAL_DAYS:
+            return self._full_refresh()
+
+        days = []
+        while day.date() <= today.date():
+            days.append(day.strftime('%Y-%m-%d') + '*')
+            day += timedelta(days=1)
+
+        print >>sys.stderr, "Incrementally refreshing inventory cache for {0}".format(self.region)
+        snapshots = self.ec2.get_all_snapshots(owner='self', filters={'start-time': days})
+        images = self.ec2.get_all_images(owners='self')
+
+        with self.db:
+            self._store_snapshots(snapshots)
+            self._store_images(images)
+            self._mark_refreshed()
+
+    def _store_snapshots(self, snapshots):
+        self.db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)',
+                            ((self.region, self.account, snapshot.id, snapshot.description, snapshot.volume_size,
+                              snapshot.start_time) for snapshot in snapshots))
+
+    def _store_images(self, images):
+        self.db.execute('DELETE FROM images WHERE region=? AND account=?', (self.region, self.account))
+        self.db.execute('DELETE FROM image_devices WHERE region=? AND account=?', (self.region, self.account))
+        self.db.executemany('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                            ((self.region, self.account, image.id, image.name, image.description,
+                              image.root_device_name) for image in images))
+        self.db.executemany('INSERT INTO image_devices VALUES (?, ?, ?, ?, ?)',
+                            ((self.region, self.account, image.id, device, volume.snapshot_id)
+                             for image in images for device, volume in image.block_device_mapping.iteritems()))
+
+    def _mark_refreshed(self, full=False):
+        if full:
+            self.db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)',
+                            (self.region, self.account, time.time(), time.time()))
+        else:
+            self.db.execute('UPDATE refreshes SET refreshed=? WHERE region=? AND account=?',
+                            (time.time(), self.region, self.account))
+
+    def images(self):
+        """
+        Yields the cached images as image_records. Images and their devices are merge-joined in id order so memory
+        stays flat regardless of inventory size.
+        """
+        devices = self.db.execute('SELECT image_id, device, snapshot_id FROM image_devices '
+                                  'WHERE region=? AND account=? ORDER BY image_id', (self.region, self.account))
+        device = devices.fetchone()
+
+        for image_id, name, description, root_device_name in self.db.execute(
+                'SELECT id, name, description, root_device_name FROM images WHERE region=? AND account=? ORDER BY id',
+                (self.region, self.account)):
+            mapping = {}
+            while device and device[0] <= image_id:
+                if device[0] == image_id:
+                    mapping[device[1]] = device_record(device[2])
+                device = devices.fetchone()
+
+            yield image_record(image_id, name, description, root_device_name, mapping)
+
+    def snapshots(self):
+        """
+        Yields the cached snapshots as snapshot_records.
+        """
+        for row in self.db.execute('SELECT id, description, volume_size, start_time FROM snapshots '
+                                   'WHERE region=? AND account=?', (self.region, self.account)):
+            yield snapshot_record(*row)
+
+    def remove_images(self, image_ids):
+        """
+        Drops deregistered images from the cache. Their snapshots are dropped separately with remove_snapshots once
+        they are actually deleted.
+        """
+        with self.db:
+            for image_id in image_ids:
+                self.db.execute('DELETE FROM image_devices WHERE region=? AND account=? AND image_id=?',
+                                (self.region, self.account, image_id))
+                self.db.execute('DELETE FROM images WHERE region=? AND account=? AND id=?',
+                                (self.region, self.account, image_id))
+
+    def remove_snapshots(self, snap_ids):
+        """
+        Drops deleted snapshots from the cache.
+        """
+        with self.db:
+            self.db.executemany('DELETE FROM snapshots WHERE region=? AND account=? AND id=?',
+                                ((self.region, self.account, snap_id) for snap_id in snap_ids))
+
+# Image names written by mass-asg-rebuild.py: <cluster>-autoscale-<YYYY-mm-dd-HH-MM-SS>
+AUTOSCALE_NAME = re.compile(r'^(?P<cluster>.+)-autoscale-(?P<timestamp>\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})$')
+
+# Maximum number of values sent in a single EC2 filter.
+FILTER_CHUNK = 200
+
+def regex_to_wildcard(pattern):
+    """
+    Converts a regex into an EC2 filter wildcard that matches a superset of what re.search would match, so it can be
+    pushed down to DescribeImages with the exact regex applied locally afterwards.
+    Returns None when the regex can't be expressed (groups, alternation) or the wildcard would match everything.
+    :param pattern: Regular expression. Ex. chef-autoscale-2014-0[67]-01
+    """
+    if not pattern:
+        return None
+
+    atoms = []
+    anchored_start = pattern.startswith('^')
+    anchored_end = pattern.endswith('$') and not pattern.endswith('\\$')
+    i = 1 if anchored_start else 0
+    end = len(pattern) - 1 if anchored_end else len(pattern)
+
+    while i < end:
+        c = pattern[i]
+        if c in '()|^$':
+            return None
+        elif c == '.':
+            atom = '?'
+            i += 1
+        elif c == '[':
+            # A ] first in the class, after an optional ^, is a literal member.
+            start = i + 2 if pattern[i + 1:i + 2] == '^' else i + 1
+            if pattern[start:start + 1] == ']':
+                start += 1
+            close = pattern.find(']', start)
+            if close == -1 or '\\' in pattern[i:close]:
+                # An escape inside the class (e.g. [\]]) may hide the real closing bracket.
+                return None
+            atom = '?'
+            i = close + 1
+        elif c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if escaped in ('d', 'w', 's', 'D', 'W', 'S'):
+                atom = '?'
+            elif escaped and not escaped.isalnum():
+                atom = '\\' + escaped if escaped in '*?\\' else escaped
+            else:
+                return None
+            i += 2
+        elif c in '*+?{':
+            return None
+        else:
+            atom = '\\' + c if c in '*?' else c
+            i += 1
+
+        # A quantified atom may repeat or vanish, so widen it to a wildcard.
+        if i < end and pattern[i] in '*+?{':
+            if pattern[i] == '{':
+                close = pattern.find('}', i)
+                if close == -1:
+                    return None
+                i = close + 1
+            else:
+                i += 1
+            if i < end and pattern[i] == '?':
+                i += 1
+            atom = '*'
+
+        atoms.append(atom)
+
+    wildcard = ''.join(atoms)
+    if not anchored_start:
+        wildcard = '*' + wildcard
+    if not anchored_end:
+        wildcard += '*'
+    wildcard = re.sub(r'(?<!\\)\*+', '*', wildcard)
+
+    if not wildcard.replace('*', ''):
+        return None
+
+    return wildcard
+
+# Serializes output from region threads so lines and records never interleave.
+output_lock = threading.Lock()
+
+def say(line, output_format='text'):
+    """
+    Prints a human readable line. In jsonl mode it goes to stderr so stdout only carries records.
+    """
+    stream = sys.stderr if output_format == 'jsonl' else sys.stdout
+    with output_lock:
+        stream.write(line + "\n")
+
+def emit(record, line, output_format='text'):
+    """
+    Writes one result as soon as it is classified: a JSON line in jsonl mode, otherwise the human readable line.
+    """
+    with output_lock:
+        if output_format == 'jsonl':
+            sys.stdout.write(json.dumps(record) + "\n")
+            sys.stdout.flush()
+        else:
+            sys.stdout.write(line + "\n")
+
+def is_throttled(e):
+    """
+    Returns True if the exception is an EC2 throttling response.
+    """
+    return getattr(e, 'error_code', None) in THROTTLE_CODES
+
+def with_backoff(call, limiter, retries=6):
+    """
+    Runs call() through the rate limiter, retrying throttled calls with exponential backoff and jitter.
+    Any other error, or running out of retries, raises the last exception.
+    """
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            result = call()
+            limiter.succeeded()
+            return result
+        except Exception as e:
+            if not is_throttled(e) or attempt == retries:
+                raise
+            limiter.throttled()
+            time.sleep(min(30, 2 ** attempt + random.random()))
 
 class ami(object):
-    def __init__(self):
+    def __init__(self, region=None, cache=True, refresh=False, ttl=CACHE_TTL, output_format='text', connection=None,
+                 cache_path=CACHE_PATH):
+        self.inventory = None
+        self.output_format = output_format
+        self.refresh = refresh
+        self.refreshed = False
+        self.summary = (0, 0)
+        # Prefix for output lines when several regions are scanned at once.
+        self.label = "[{0}] ".format(region) if region else ""
         try:
-            self.ec2 = boto.connect_ec2()
+            if connection:
+                self.ec2 = connection
+            elif region:
+                self.ec2 = boto.ec2.connect_to_region(region)
+            else:
+                self.ec2 = boto.connect_ec2()
+            if cache:
+                account = get_account_id(self.ec2)
+                if account:
+                    self.inventory = inventory(self.ec2, path=cache_path, ttl=ttl, account=account)
+                else:
+                    # Caching under a guessed account could serve another account's inventory.
+                    say(self.label + "Unable to determine the account; not using the inventory cache.",
+                        output_format)
         except Exception as e:
             print e
             return -1
 
+    def _cached(self):
+        """
+        Returns the inventory cache, refreshing it on first use, or None if caching is disabled.
+        """
+        if self.inventory and not self.refreshed:
+            self.inventory.refresh(force=self.refresh)
+            self.refreshed = True
+
+        return self.inventory
+
+    def get_images(self, pattern=None):
+        """
+        Returns self-owned images, from the inventory cache when enabled.
+        :param pattern: Optional regex. When querying EC2 directly and the regex converts to a wildcard, only images
+        whose name or description match the wildcard are fetched. Callers must still apply the regex.
+        """
+        if self._cached():
+            return self.inventory.images()
+
+        wildcard = regex_to_wildcard(pattern)
+        if not wildcard:
+            return self.ec2.get_all_images(owners='self')
+
+        # EC2 ANDs different filters together, so name and description matches are fetched separately.
+        images = {}
+        for field in ('name', 'description'):
+            for image in self.ec2.get_all_images(owners='self', filters={field: wildcard}):
+                images[image.id] = image
+
+        return images.values()
+
+    def get_snapshots(self, snapshot_ids=None):
+        """
+        Returns self-owned snapshots, from the inventory cache when enabled.
+        :param snapshot_ids: Optional list of snapshot ids to limit a direct EC2 query to.
+        """
+        if self._cached():
+            return self.inventory.snapshots()
+
+        if snapshot_ids is None:
+            return self.ec2.get_all_snapshots(owner='self')
+
+        snapshots = []
+        for i in range(0, len(snapshot_ids), FILTER_CHUNK):
+            snapshots.extend(self.ec2.get_all_snapshots(owner='self',
+                                                        filters={'snapshot-id': snapshot_ids[i:i + FILTER_CHUNK]}))
+
+        return snapshots
+
     def create(self, instance_id, name, desc):
         """
         Creates an AMI image.
@@ -33,14 +478,100 @@ class ami(object):
         print "{0} => {1}".format(instance_id, ami)
         return
 
+    def create_batch(self, instance_ids, name, desc, workers=10, rate=5):
+        """
+        Creates AMI images for many instances concurrently.
+        :param instance_ids: List of instance ids to image.
+        :param name: Image name. {instance_id} is replaced with the instance id; without it, the instance id is
+        appended when imaging more than one instance so names stay unique.
+        :param desc: Description of the images.
+        :return: List of (instance_id, ami_id) tuples for the images that were created.
+        """
+        if not instance_ids:
+            return []
+
+        if '{instance_id}' not in name and len(instance_ids) > 1:
+            name += '-{instance_id}'
+
+        limiter = rate_limiter(rate)
+
+        def worker(instance_id):
+            try:
+                ami = with_backoff(lambda: self.ec2.create_image(instance_id, name.format(instance_id=instance_id),
+                                                                 description=desc), limiter)
+            except Exception as e:
+                say("Failed to issue create_image for {0}".format(instance_id))
+                say(str(e))
+                return instance_id, None
+
+            say("{0} => {1}".format(instance_id, ami))
+            return instance_id, ami
+
+        pool = ThreadPool(min(workers, len(instance_ids)))
+        try:
+            results = pool.map(worker, instance_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [(instance_id, ami) for instance_id, ami in results if ami]
+
+    def wait_for_images(self, ami_ids, timeout=3600, interval=5, max_interval=60):
+        """
+        Waits for images to leave the pending state, polling every pending image with one DescribeImages call per
+        cycle and backing off between cycles.
+        :param ami_ids: List of ami ids to wait for.
+        :param timeout: Seconds to wait before giving up on the remaining images.
+        :return: Dict of ami id => final state. Images still pending at the timeout are reported as 'pending'.
+        """
+        states = dict((ami_id, 'pending') for ami_id in ami_ids)
+        pending = set(ami_ids)
+        limiter = rate_limiter(1)
+        deadline = time.time() + timeout
+
+        while pending and time.time() < deadline:
+            time.sleep(interval + random.random())
+            ids = list(pending)
+            for i in range(0, len(ids), FILTER_CHUNK):
+                # A filter, rather than image_ids, so images that aren't visible yet don't fail the whole call.
+                try:
+                    images = with_backoff(lambda: self.ec2.get_all_images(filters={'image-id': ids[i:i + FILTER_CHUNK]}),
+                                          limiter)
+                except Exception as e:
+                    say("Failed to poll image status.")
+                    say(str(e))
+                    continue
+
+                for image in images:
+                    if image.state in ('available', 'failed'):
+                        states[image.id] = image.state
+                        pending.discard(image.id)
+                        say("{0} {1}.".format(image.id, image.state))
+
+            interval = min(max_interval, interval * 1.5)
+
+        for ami_id in pending:
+            say("{0} timed out.".format(ami_id))
+
+        return states
+
     def delete(self, ami):
         """
         Deletes the supplied ami-id.
         :param ami: Ami ID. Ex. ami-4234563
         """
         try:
-            self.ec2.deregister_image(ami, delete_snapshot=True)
+            image = self.ec2.get_image(ami)
+            root = image.block_device_mapping.get(image.root_device_name)
+            self.ec2.deregister_image(ami)
+            deleted = []
+            if root and root.snapshot_id:
+                self.ec2.delete_snapshot(root.snapshot_id)
+                deleted.append(root.snapshot_id)
             print "Deleted {0}".format(ami)
+            if self.inventory:
+                self.inventory.remove_images([ami])
+                self.inventory.remove_snapshots(deleted)
         except Exception as e:
             print "Failed to delete {0}".format(ami)
             print e
@@ -56,6 +587,8 @@ class ami(object):
         try:
             self.ec2.delete_snapshot(snap_id)
             print "Deleted {0}".format(snap_id)
+            if self.inventory:
+                self.inventory.remove_snapshots([snap_id])
         except Exception as e:
             print "Failed to delete {0}".format(snap_id)
             print e
@@ -63,79 +596,355 @@ class ami(object):
 
         return
 
-    def search(self, pattern):
+    def root_snapshots(self, ami_ids, limiter, retries=6):
+        """
+        Looks up the root device snapshot of each image, one DescribeImages call per chunk of ids.
+        :param ami_ids: List of ami ids.
+        :return: Dict of ami id => root snapshot id, for images that have one.
+        """
+        snapshots = {}
+        for i in range(0, len(ami_ids), FILTER_CHUNK):
+            chunk = ami_ids[i:i + FILTER_CHUNK]
+            images = with_backoff(lambda: self.ec2.get_all_images(filters={'image-id': chunk}), limiter, retries)
+            for image in images:
+                root = image.block_device_mapping.get(image.root_device_name)
+                if root and root.snapshot_id:
+                    snapshots[image.id] = root.snapshot_id
+
+        return snapshots
+
+    def bulk_delete(self, object_ids, kind, workers=10, rate=10, retries=6):
+        """
+        Deletes images or snapshots concurrently on a bounded worker pool. Throttled calls are retried with
+        exponential backoff and slow down every worker through a shared rate limiter.
+        Images are deregistered and then their root snapshot deleted, each as its own retried call, so a throttled
+        snapshot delete never re-runs a deregister that already succeeded.
+        :param object_ids: List of ami or snapshot ids.
+        :param kind: 'ami' or 'snapshot'.
+        :param workers: Maximum number of concurrent delete calls.
+        :param rate: Starting number of delete calls per second.
+        :param retries: Number of retries for a throttled call.
+        :return: Tuple of (succeeded, failed) id lists.
+        """
+        if not object_ids:
+            return [], []
+
+        limiter = rate_limiter(rate)
+        lock = threading.Lock()
+        total = len(object_ids)
+        progress = {'done': 0}
+        snapshots = {}
+        if kind == 'ami':
+            try:
+                snapshots = self.root_snapshots(object_ids, limiter, retries)
+            except Exception as e:
+                say("Failed to look up the images' root snapshots.", self.output_format)
+                say(str(e), self.output_format)
+                return [], list(object_ids)
+
+        def worker(object_id):
+            error = None
+            snap_error = None
+            try:
+                if kind == 'ami':
+                    with_backoff(lambda: self.ec2.deregister_image(object_id), limiter, retries)
+                else:
+                    with_backoff(lambda: self.ec2.delete_snapshot(object_id), limiter, retries)
+            except Exception as e:
+                error = e
+
+            if error is None and object_id in snapshots:
+                try:
+                    with_backoff(lambda: self.ec2.delete_snapshot(snapshots[object_id]), limiter, retries)
+                except Exception as e:
+                    snap_error = e
+
+            with lock:
+                progress['done'] += 1
+                if error is None:
+                    say("[{0}/{1}] Deleted {2}".format(progress['done'], total, object_id), self.output_format)
+                else:
+                    say("[{0}/{1}] Failed to delete {2}".format(progress['done'], total, object_id), self.output_format)
+                    say(str(error), self.output_format)
+                if snap_error is not None:
+                    say("Failed to delete snapshot {0} of {1}".format(snapshots[object_id], object_id),
+                        self.output_format)
+                    say(str(snap_error), self.output_format)
+
+            deleted = object_id if kind == 'snapshot' else snapshots.get(object_id)
+            return object_id, error is None, error is None and snap_error is None and deleted
+
+        pool = ThreadPool(min(workers, total))
+        try:
+            results = pool.map(worker, object_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+        succeeded = [object_id for object_id, ok, deleted in results if ok]
+        failed = [object_id for object_id, ok, deleted in results if not ok]
+
+        if self.inventory:
+            if kind == 'ami':
+                self.inventory.remove_images(succeeded)
+            # Only the snapshots actually deleted; others stay cached so orphan scans still report them.
+            self.inventory.remove_snapshots([deleted for object_id, ok, deleted in results if deleted])
+
+        say("-----------------------", self.output_format)
+        say("     DELETE SUMMARY    ", self.output_format)
+        say("-----------------------", self.output_format)
+        say("succeeded: {0} failed: {1}".format(len(succeeded), len(failed)), self.output_format)
+        for object_id in failed:
+            say("failed: {0}".format(object_id), self.output_format)
+
+        return succeeded, failed
+
+    def search(self, pattern, collect=True):
         """
         Builds a list of ami's based on the supplied regex pattern
         :param pattern: Regular expression pattern to search on. Ex. chef-autoscale-2014-0[67]-01
+        :param collect: Keep matches in the returned list. Streaming callers that only need the output can pass
+        False to keep memory flat.
         """
         images = []
         count = 0
         space = 0
-        snap_id = ""
 
         try:
-            amis = self.ec2.get_all_images(owners='self')
+            amis = self.get_images(pattern)
         except Exception as e:
-            print "Failed to get AMI's."
-            print e
+            say("Failed to get AMI's.", self.output_format)
+            say(str(e), self.output_format)
             return -1
 
+        # The wildcard filter is only a pre-selection; the regex is the final check.
+        amis = (ami for ami in amis
+                if ami and (re.search(pattern, str(ami.description)) or re.search(pattern, str(ami.name))))
+
+        snapshot_ids = None
+        if not self.inventory and regex_to_wildcard(pattern):
+            # A narrow search only needs the snapshots behind the matched images.
+            amis = list(amis)
+            snapshot_ids = list(set(volume.snapshot_id for ami in amis
+                                    for volume in ami.block_device_mapping.values() if volume.snapshot_id))
+
         try:
-            snapshots = self.ec2.get_all_snapshots(owner='self')
+            snapshots = self.get_snapshots(snapshot_ids)
         except Exception as e:
-            print "Failed to get snapshots."
-            print e
+            say("Failed to get snapshots.", self.output_format)
+            say(str(e), self.output_format)
             return -1
 
+        # Index snapshot sizes by id so each block device is a single lookup.
+        snapshot_sizes = dict((snapshot.id, snapshot.volume_size) for snapshot in snapshots)
+
         for ami in amis:
-            if ami and (re.search(pattern, str(ami.description)) or re.search(pattern, str(ami.name))):
-                count += 1
-                print "{0:s} => {1:s} {2:s}".format(ami.id, ami.name, ami.description)
-                for device, volume in ami.block_device_mapping.iteritems():
-                    if volume.snapshot_id:
-                        snap_id = volume.snapshot_id
+            count += 1
+            snap_ids = []
+            size = 0
+            for device, volume in ami.block_device_mapping.iteritems():
+                if volume.snapshot_id:
+                    snap_ids.append(volume.snapshot_id)
+                    size += snapshot_sizes.get(volume.snapshot_id, 0)
+            space += size
 
-                images.append((ami.id, ami.name, ami.description, snap_id))
+            emit({'type': 'image', 'region': self.ec2.region.name, 'id': ami.id, 'name': ami.name,
+                  'description': ami.description, 'snapshot_ids': snap_ids, 'size': size},
+                 "{0}{1:s} => {2:s} {3:s}".format(self.label, ami.id, ami.name, ami.description), self.output_format)
 
-        for snapshot in snapshots:
-            for ami_id, ami_name, ami_description, snap_id in images:
-                if snapshot.id == snap_id:
-                    size = snapshot.volume_size
-                    space += size
+            if collect:
+                images.append((ami.id, ami.name, ami.description, snap_ids))
 
-        print "-----------------------"
-        print "        SUMMARY        "
-        print "-----------------------"
-        print "total amis found: {0} total space occupied: {1}GB".format(count, space)
+        say("-----------------------", self.output_format)
+        say("        SUMMARY        ", self.output_format)
+        say("-----------------------", self.output_format)
+        say("{0}total amis found: {1} total space occupied: {2}GB".format(self.label, count, space), self.output_format)
+        self.summary = (count, space)
         return images
 
-    def find_orphans(self):
+    def find_orphans(self, collect=True):
         """
         Finds orphaned AMI snapshots. Returns a list.
+        :param collect: Keep orphans in the returned list. Streaming callers that only need the output can pass
+        False to keep memory flat.
         """
         orphans = []
         space = 0
         count = 0
-        for snapshot in self.ec2.get_all_snapshots(owner='self'):
+
+        # Pull the full image inventory once and classify snapshots against it in memory. Snapshots are listed
+        # first so an image registered mid-scan can never make its new snapshots look orphaned.
+        try:
+            snapshots = self.get_snapshots()
+        except Exception as e:
+            say("Failed to get snapshots.", self.output_format)
+            say(str(e), self.output_format)
+            return -1
+
+        try:
+            image_ids = set(image.id for image in self.get_images())
+        except Exception as e:
+            say("Failed to get AMI's.", self.output_format)
+            say(str(e), self.output_format)
+            return -1
+
+        for snapshot in snapshots:
             if snapshot.description:
                 match = re.search(r'ami-[0-9A-Fa-f]+', snapshot.description)
-                if match:
-                    try:
-                        ami = self.ec2.get_image(match.group())
-                    except Exception as e:
-                        ami = None
-
-                    if not ami:
+                if match and match.group() not in image_ids:
+                    space = space+snapshot.volume_size
+                    count += 1
+                    emit({'type': 'orphan', 'region': self.ec2.region.name, 'id': snapshot.id, 'name': None,
+                          'ami_id': match.group(), 'snapshot_ids': [snapshot.id], 'size': snapshot.volume_size},
+                         "{0}orphaned ami snapshot: {1:s} => {2:s} {3}GB".format(self.label, snapshot.id, match.group(),
+                                                                                snapshot.volume_size),
+                         self.output_format)
+                    if collect:
                         orphans.append((snapshot.id, match.group()))
-                        space = space+snapshot.volume_size
-                        count += 1
-                        print "orphaned ami snapshot: {0:s} => {1:s} {2}GB".format(snapshot.id, match.group(), snapshot.volume_size)
+
+        say("-----------------------", self.output_format)
+        say("        SUMMARY        ", self.output_format)
+        say("-----------------------", self.output_format)
+        say("{0}total orphans: {1} total space: {2}GB".format(self.label, count, space), self.output_format)
+        self.summary = (count, space)
+        return orphans
+
+    def in_use_images(self):
+        """
+        Returns the set of image ids referenced by launch configurations in this region.
+        """
+        autoscale = boto.ec2.autoscale.connect_to_region(self.ec2.region.name)
+        image_ids = set()
+        next_token = None
+        while True:
+            configs = autoscale.get_all_launch_configurations(next_token=next_token)
+            image_ids.update(config.image_id for config in configs)
+            next_token = configs.next_token
+            if not next_token:
+                break
+
+        return image_ids
+
+    def prune(self, keep, in_use=None):
+        """
+        Picks autoscale images to delete in a single pass over the inventory, keeping the newest per cluster.
+        Prints a diff of kept (' '), deleted ('-') and in-use ('!') images per cluster.
+        :param keep: Number of images to keep per cluster.
+        :param in_use: Optional set of image ids that must never be deleted.
+        :return: List of ami ids to delete.
+        """
+        in_use = in_use or set()
+        newest = defaultdict(list)
+        doomed = defaultdict(list)
+        protected = defaultdict(list)
+
+        for image in self.get_images('-autoscale-'):
+            match = AUTOSCALE_NAME.match(str(image.name))
+            if not match:
+                continue
+
+            cluster = match.group('cluster')
+            entry = (match.group('timestamp'), image.id, image.name)
+            if image.id in in_use:
+                protected[cluster].append(entry)
+                continue
+
+            # Each cluster's heap holds its newest `keep` images; anything pushed out is deleted.
+            heap = newest[cluster]
+            if len(heap) < keep:
+                heapq.heappush(heap, entry)
+            else:
+                doomed[cluster].append(heapq.heappushpop(heap, entry))
+
+        clusters = sorted(set(newest) | set(doomed) | set(protected))
+        for cluster in clusters:
+            print "{0}:".format(cluster)
+            lines = [(kept, ' ') for kept in newest[cluster]] + [(pruned, '-') for pruned in doomed[cluster]] + \
+                    [(skipped, '!') for skipped in protected[cluster]]
+            for (timestamp, image_id, name), marker in sorted(lines, reverse=True):
+                print "{0} {1} {2}".format(marker, image_id, name)
+
+        ami_ids = [image_id for cluster in clusters for timestamp, image_id, name in doomed[cluster]]
 
         print "-----------------------"
         print "        SUMMARY        "
         print "-----------------------"
-        print "total orphans: {0} total space: {1}GB".format(count, space)
-        return orphans
+        print "clusters: {0} keep: {1} in use: {2} delete: {3}".format(
+            len(clusters), sum(len(heap) for heap in newest.values()), sum(len(l) for l in protected.values()),
+            len(ami_ids))
+
+        return ami_ids
+
+def get_regions(regions, output_format='text'):
+    """
+    Expands the --regions argument into a list of region names. Unknown region names are reported and left out.
+    :param regions: Comma separated region names, or 'all'.
+    """
+    if not regions:
+        return [None]
+
+    known = [r.name for r in boto.ec2.regions()]
+    if regions == 'all':
+        # GovCloud and China need separate credentials.
+        return [name for name in known if not name.startswith(('us-gov', 'cn-'))]
+
+    names = [region.strip() for region in regions.split(',') if region.strip()]
+    for name in names:
+        if name not in known:
+            say("Unknown region: {0}".format(name), output_format)
+
+    return [name for name in names if name in known]
+
+def scan_regions(regions, mode, pattern, cache=True, refresh=False, ttl=CACHE_TTL, output_format='text', collect=True):
+    """
+    Runs an AMI search or orphan scan in every region concurrently, one connection per region, and prints a merged
+    report with per-region subtotals.
+    :param regions: List of region names. [None] scans the local region only.
+    :param mode: 'ami' or 'orphan'.
+    :param pattern: Regular expression for AMI searches.
+    :param output_format: 'text' or 'jsonl'.
+    :param collect: Keep results in memory, needed for --delete.
+    :return: List of (api, results) tuples in region order.
+    """
+    def scan(region):
+        # A failing region is reported on its own and doesn't abort the other regions' scans.
+        try:
+            api = ami(region=region, cache=cache, refresh=refresh, ttl=ttl, output_format=output_format)
+            if mode == 'ami':
+                results = api.search(pattern, collect=collect)
+            else:
+                results = api.find_orphans(collect=collect)
+        except Exception as e:
+            say("[{0}] Scan failed: {1}".format(region, e), output_format)
+            return None, []
+        if results == -1:
+            results = []
+        return api, results
+
+    pool = ThreadPool(len(regions))
+    try:
+        scans = pool.map(scan, regions)
+    finally:
+        pool.close()
+        pool.join()
+
+    if len(regions) > 1:
+        say("-----------------------", output_format)
+        say("    REGION SUMMARY     ", output_format)
+        say("-----------------------", output_format)
+        total_count = 0
+        total_space = 0
+        for region, (api, results) in zip(regions, scans):
+            if api is None:
+                say("{0}: scan failed".format(region), output_format)
+                continue
+            count, space = api.summary
+            total_count += count
+            total_space += space
+            say("{0}: {1} found {2}GB".format(region, count, space), output_format)
+        say("all regions: {0} found {1}GB".format(total_count, total_space), output_format)
+
+    return scans
 
 def main():
 
@@ -144,9 +953,14 @@ def main():
 
     create_parser = subparsers.add_parser('create', help='Create an AMI image.')
     create_parser.set_defaults(operation='create')
-    create_parser.add_argument('--instance-id', help='Instance-id to create an AMI from.', required=True)
-    create_parser.add_argument('--name', help='Image name.', required=True)
+    create_parser.add_argument('--instance-id', help='Instance-id(s) to create an AMI from.', nargs='+', default=[])
+    create_parser.add_argument('--instance-file', help='File with one instance-id per line to create AMIs from.')
+    create_parser.add_argument('--name', help='Image name. {instance_id} is replaced with the instance id.',
+                               required=True)
     create_parser.add_argument('--desc', help='Description of the image.', default="Amitool created image.")
+    create_parser.add_argument('--wait', action='store_true', help='Wait until every image is available or failed.')
+    create_parser.add_argument('--timeout', type=int, default=3600, help='Seconds to wait with --wait.')
+    create_parser.add_argument('--workers', type=int, default=10, help='Number of concurrent create calls.')
     delete_parser = subparsers.add_parser('delete', help='Delete an AMI image and associated snapshot.')
     delete_parser.set_defaults(operation='delete')
     delete_parser.add_argument('ami_id', action='store', help='ami-id to delete.')
@@ -159,32 +973,99 @@ def main():
     search_parser.add_argument('mode', choices=['ami', 'orphan'])
     search_parser.add_argument('--regex', help='Regex pattern for AMI search.', default='.*')
     search_parser.add_argument('--delete', action='store_true', help='WARNING: This flag will delete objects returned by search.')
+    search_parser.add_argument('--workers', type=int, default=10, help='Number of concurrent delete calls.')
+    search_parser.add_argument('--refresh', action='store_true', help='Discard the local inventory cache and '
+                                                                      're-download images and snapshots.')
+    search_parser.add_argument('--no-cache', action='store_true', help='Query EC2 directly instead of the local '
+                                                                       'inventory cache.')
+    search_parser.add_argument('--ttl', type=int, default=CACHE_TTL, help='Seconds before the inventory cache is '
+                                                                          'incrementally refreshed.')
+    search_parser.add_argument('--regions', help='Comma separated regions to scan concurrently, or "all". '
+                                                 'Defaults to the local region.')
+    search_parser.add_argument('--format', choices=['text', 'jsonl'], default='text',
+                               help='Output format. jsonl streams one JSON record per match to stdout as it is found '
+                                    'and sends everything else to stderr.')
+
+    prune_parser = subparsers.add_parser('prune', help='Delete old <cluster>-autoscale-<timestamp> images, keeping the '
+                                                       'newest per cluster.')
+    prune_parser.set_defaults(operation='prune')
+    prune_parser.add_argument('--keep', type=int, default=3, help='Number of images to keep per cluster.')
+    prune_parser.add_argument('--skip-in-use', action='store_true', help='Never delete images used by launch '
+                                                                         'configurations.')
+    prune_parser.add_argument('--dry-run', action='store_true', help='Only print what would be kept and deleted.')
+    prune_parser.add_argument('--yes', action='store_true', help='Delete without asking for confirmation.')
+    prune_parser.add_argument('--workers', type=int, default=10, help='Number of concurrent delete calls.')
+    prune_parser.add_argument('--refresh', action='store_true', help='Discard the local inventory cache and '
+                                                                     're-download images and snapshots.')
+    prune_parser.add_argument('--no-cache', action='store_true', help='Query EC2 directly instead of the local '
+                                                                      'inventory cache.')
 
     args = vars(parser.parse_args())
-    api = ami()
 
     if args['operation'] == 'create':
-        api.create(args['instance_id'], args['name'],args['desc'])
+        instance_ids = list(args['instance_id'])
+        if args['instance_file']:
+            with open(args['instance_file']) as f:
+                instance_ids.extend(line.strip() for line in f if line.strip())
+        if not instance_ids:
+            parser.error('create requires --instance-id or --instance-file')
+
+        api = ami(cache=False)
+        if len(instance_ids) == 1 and not args['wait']:
+            api.create(instance_ids[0], args['name'].format(instance_id=instance_ids[0]), args['desc'])
+        else:
+            created = api.create_batch(instance_ids, args['name'], args['desc'], workers=args['workers'])
+            failed = len(instance_ids) - len(created)
+            if args['wait'] and created:
+                states = api.wait_for_images([ami_id for instance_id, ami_id in created], timeout=args['timeout'])
+                failed += len([state for state in states.values() if state != 'available'])
+            if failed:
+                sys.exit(1)
     if args['operation'] == 'delete':
+        api = ami(cache=False)
         print "Deleting {0}".format(args['ami_id'])
         api.delete(args['ami_id'])
     if args['operation'] == "search":
+        regions = get_regions(args['regions'], args['format'])
+        if not regions:
+            sys.exit(1)
         if args['mode'] == 'ami':
-            print "Finding images matching regex: {0}".format(args['regex'])
-            images = api.search(args['regex'])
-            if images and args['delete']:
-                confirmation = raw_input('Confirm DELETE of found images (Y/N): ')
-                if confirmation == 'Y':
-                    for ami_id, ami_name, ami_description, snap_id in images:
-                        api.delete(ami_id)
+            say("Finding images matching regex: {0}".format(args['regex']), args['format'])
         if args['mode'] == 'orphan':
-            print "Finding orphans"
-            orphans = api.find_orphans()
-            if orphans and args['delete']:
-                confirmation = raw_input('Confirm DELETE of found orphans (Y/N): ')
-                if confirmation == 'Y':
-                    for snap_id, ami_id in orphans:
-                        api.delete_snapshot(snap_id)
+            say("Finding orphans", args['format'])
+
+        # Results are only held in memory when they are needed for deletion.
+        scans = scan_regions(regions, args['mode'], args['regex'], cache=not args['no_cache'],
+                             refresh=args['refresh'], ttl=args['ttl'], output_format=args['format'],
+                             collect=args['delete'])
+
+        if args['delete'] and any(results for api, results in scans):
+            if args['mode'] == 'ami':
+                sys.stderr.write('Confirm DELETE of found images (Y/N): ')
+            else:
+                sys.stderr.write('Confirm DELETE of found orphans (Y/N): ')
+            confirmation = raw_input()
+            if confirmation == 'Y':
+                for api, results in scans:
+                    if not results:
+                        continue
+                    if args['mode'] == 'ami':
+                        api.bulk_delete([ami_id for ami_id, ami_name, ami_description, snap_ids in results], 'ami',
+                                        workers=args['workers'])
+                    else:
+                        api.bulk_delete([snap_id for snap_id, ami_id in results], 'snapshot',
+                                        workers=args['workers'])
+    if args['operation'] == 'prune':
+        if args['keep'] < 1:
+            parser.error('--keep must be at least 1')
+        api = ami(cache=not args['no_cache'], refresh=args['refresh'])
+        in_use = None
+        if args['skip_in_use']:
+            in_use = api.in_use_images()
+        ami_ids = api.prune(args['keep'], in_use)
+        if ami_ids and not args['dry_run']:
+            if args['yes'] or raw_input('Confirm DELETE of pruned images (Y/N): ') == 'Y':
+                api.bulk_delete(ami_ids, 'ami', workers=args['workers'])
 
 if __name__ == "__main__":
     main()
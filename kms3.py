@@ -11,11 +11,18 @@ import argparse
 import base64
 import binascii
 import boto
+import ctypes
+import ctypes.util
 import json
 import time
 import os
 import random
+import socket
+import stat
+import struct
 import subprocess
+import threading
+import SocketServer
 import StringIO
 from subprocess import call
 from argparse import RawTextHelpFormatter
@@ -24,8 +31,24 @@ from boto.s3.key import Key
 from Crypto.Cipher import AES
 from hashlib import sha256
 
+# Environment variable naming the key agent socket clients should use.
+AGENT_SOCKET_ENV = "KMS3_AGENT_SOCK"
+# The default socket lives in a per-user 0700 directory so other local users can't bind or reach it.
+AGENT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/dev/shm", "kms3-{0}".format(os.getuid()),
+                            "agent.sock")
+# Seconds to wait on the key agent before falling back to KMS. Covers the agent's own KMS call on a cold key.
+AGENT_TIMEOUT = 30
+
 class kms3(object):
-    def __init__(self):
+    def __init__(self, key_ttl=300, agent_socket=None):
+        """
+        :param key_ttl: Seconds a decrypted data key is cached in this process. 0 disables the cache.
+        :param agent_socket: Path of a key agent socket to fetch data keys from, if one is running.
+        """
+        self.key_ttl = key_ttl
+        self.agent_socket = agent_socket
+        # Cluster name => (data key, expiry time)
+        self.key_cache = {}
         try:
             # Get the account id
             response = boto.utils.get_instance_identity()
@@ -38,6 +61,10 @@ class kms3(object):
             self.__chef_role_arn__ = "arn:aws:iam::" + self.acct_id + ":role/chef"
             self.__key_spec__ = "AES_256"
             self.k = 16
+            # Streaming buffer size; a multiple of the AES block size.
+            self.chunk_size = 1024 * 1024
+            # Minimum multipart upload part size. S3 requires at least 5 MB for every part but the last.
+            self.part_size = 8 * 1024 * 1024
             self.recycle_key = 0
             self.recycle_role = 0
         except Exception as e:
@@ -46,6 +73,66 @@ class kms3(object):
             return
 
     def _get_data_key(self, name):
+        """
+        Internal function to retrieve the data key for a cluster. Keys are served from the in-process cache while
+        fresh, then from the key agent if one is configured, and otherwise fetched with KMS.
+        :param name:  Name of the cluster.
+        :return:
+        """
+        cached = self.key_cache.get(name)
+        if cached and cached[1] > time.time():
+            return cached[0]
+
+        decrypted_key = None
+        if self.agent_socket:
+            decrypted_key = self._get_agent_key(name)
+        if not decrypted_key:
+            decrypted_key = self._fetch_data_key(name)
+
+        if decrypted_key and self.key_ttl > 0:
+            self.key_cache[name] = (decrypted_key, time.time() + self.key_ttl)
+
+        return decrypted_key
+
+    def _get_agent_key(self, name):
+        """
+        Internal function to ask the key agent for a cluster's data key.
+        :param name:  Name of the cluster.
+        :return: The data key, or None if the agent is unreachable or couldn't get it.
+        """
+        try:
+            # Only trust an agent run by this user; anyone could be listening on a socket they created.
+            info = os.stat(self.agent_socket)
+            if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+                print "[-] Key agent socket {0} is not owned by this user; not using it.".format(self.agent_socket)
+                return
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(AGENT_TIMEOUT)
+            sock.connect(self.agent_socket)
+            # SO_PEERCRED returns struct ucred {pid, uid, gid} of the process that is listening.
+            credentials = sock.getsockopt(socket.SOL_SOCKET, getattr(socket, "SO_PEERCRED", 17),
+                                          struct.calcsize("3i"))
+            pid, uid, gid = struct.unpack("3i", credentials)
+            if uid != os.getuid():
+                sock.close()
+                print "[-] Key agent at {0} runs as uid {1}; not using it.".format(self.agent_socket, uid)
+                return
+            sock.sendall("GET " + name + "\n")
+            response = sock.makefile().readline().strip()
+            sock.close()
+        except Exception as e:
+            print "[-] Error contacting key agent at {0}".format(self.agent_socket)
+            print e
+            return
+
+        status, _, value = response.partition(" ")
+        if status != "OK":
+            print "[-] Key agent error: {0}".format(value)
+            return
+
+        return base64.b64decode(value)
+
+    def _fetch_data_key(self, name):
         """
         Internal function to retrieve the data key for a cluster using KMS and the secrets file on s3.
         :param name:  Name of the cluster.
@@ -98,28 +185,122 @@ class kms3(object):
         :param key: AES 256 key.
         :return: Returns the full path to the decrypted file.
         """
-        with open(file_name, 'rb') as fo:
-            try:
-                ciphertext = fo.read()
-            except:
-                print "[-] Error opening file {0} for reading.".format(file_name)
-                return
         try:
-            dec = self.decrypt(ciphertext, key)
+            fo = open(file_name, 'rb')
         except:
-            print "[-] Decryption failed."
+            print "[-] Error opening file {0} for reading.".format(file_name)
             return
 
-        with open(file_name[:-4], 'wb') as fo:
+        with fo:
             try:
-                fo.write(dec)
+                out = self.open_private(file_name[:-4])
             except:
                 print "[-] Error writing out file {0}".format(file_name[:-4])
                 return
 
+            with out:
+                try:
+                    self.decrypt_stream(fo, out, key)
+                except:
+                    print "[-] Decryption failed."
+                    out.close()
+                    self.secure_delete(file_name[:-4])
+                    return
+
         os.chmod(file_name[:-4], 0600)
         return file_name[:-4]
 
+    def decrypt_stream(self, src, dst, key):
+        """
+        Decrypts src into dst a chunk at a time, so memory use is constant regardless of the file size. The input is
+        the same IV + AES CBC + PKCS#7 layout produced by encrypt and encrypt_stream.
+        :param src: File object to read ciphertext from.
+        :param dst: File object to write plaintext to.
+        :param key: Key to be used for decryption
+        """
+        iv = src.read(AES.block_size)
+        if len(iv) != AES.block_size:
+            raise ValueError('Input is too short to contain an IV')
+        cipher = AES.new(key, AES.MODE_CBC, iv, segment_size=64)
+
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        # Ciphertext left over from a short read that doesn't fill a whole block.
+        carry = ''
+        # The last plaintext block is held back until EOF so its padding can be removed.
+        pending = ''
+        while True:
+            n = self._readinto(src, buf, view)
+            if not n:
+                break
+            data = carry + view[:n].tobytes() if carry else view[:n].tobytes()
+            whole = len(data) - len(data) % AES.block_size
+            carry = data[whole:]
+            if not whole:
+                continue
+
+            plaintext = cipher.decrypt(data[:whole])
+            dst.write(pending)
+            dst.write(plaintext[:-AES.block_size])
+            pending = plaintext[-AES.block_size:]
+
+        if carry or not pending:
+            raise ValueError('Input is not a whole number of blocks')
+        dst.write(self.pkcs7_unpad(pending))
+
+    def _readinto(self, src, buf, view):
+        """
+        Reads into buf from a file object, or from an object that only has read(), such as an s3 key.
+        :return: Number of bytes read; 0 at EOF.
+        """
+        if hasattr(src, 'readinto'):
+            return src.readinto(buf)
+        data = src.read(len(buf))
+        view[:len(data)] = data
+        return len(data)
+
+    def download_decrypted(self, name, file_name, key):
+        """
+        Streams an encrypted file from the cluster's s3 bucket/prefix through decrypt_stream into /dev/shm, so only
+        the plaintext is written locally and memory use doesn't grow with the file size.
+        :param name: Name of the cluster the file belongs to.
+        :param file_name: File name on s3. Ex. secrets.yml.enc
+        :param key: AES 256 key.
+        :return: Returns the full path to the decrypted file.
+        """
+        try:
+            bucket = self.s3.get_bucket(self.__secrets_bucket__)
+            s3_key = bucket.get_key("cluster/" + name + "/" + file_name)
+        except Exception as e:
+            print "[-] Error"
+            print e
+            return
+
+        directory = "/dev/shm/" + "cluster/" + name
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        out_file_path = directory + "/" + file_name[:-4]
+
+        try:
+            out = self.open_private(out_file_path)
+        except:
+            print "[-] Error writing out file {0}".format(out_file_path)
+            return
+
+        with out:
+            try:
+                self.decrypt_stream(s3_key, out, key)
+            except Exception as e:
+                print "[-] Decryption failed."
+                print e
+                out.close()
+                self.secure_delete(out_file_path)
+                return
+            finally:
+                s3_key.close()
+
+        return out_file_path
+
     def download_from_s3(self, name, file_name):
         """
         Downloads the specified file name from the cluster's s3 bucket/prefix.
@@ -207,12 +388,11 @@ class kms3(object):
         os.chmod(key_file, 0600)
         key_file_out.close()
 
-        # Download the file from s3 to /dev/shm
-        file_name = self.download_from_s3(name, file)
-        os.chmod(file_name, 0600)
-
-        # Decrypt the file before editing
-        decrypted_file_name = self.decrypt_file(file_name, decrypted_key)
+        # Download and decrypt the file to /dev/shm before editing
+        decrypted_file_name = self.download_decrypted(name, file, decrypted_key)
+        if not decrypted_file_name:
+            self.secure_delete(key_file, passes=10)
+            return
 
         # Call $EDITOR to edit the file.
         EDITOR = os.environ.get('EDITOR','vim')
@@ -222,7 +402,6 @@ class kms3(object):
         self.upload(name, decrypted_file_name)
 
         # Clean up any other files laying around
-        self.secure_delete(file_name, passes=10)
         self.secure_delete(decrypted_file_name, passes=10)
         self.secure_delete(key_file, passes=10)
 
@@ -240,22 +419,61 @@ class kms3(object):
         return iv + cipher.encrypt(message)
 
     def encrypt_file(self, file_name, key):
-        with open(file_name, 'rb') as fo:
+        """
+        Encrypts the supplied file name with the supplied key into /dev/shm.
+        :param file_name: Name of the local file to encrypt
+        :param key: AES 256 key.
+        :return: Returns the full path to the encrypted file, or None if encryption failed.
+        """
+        out_file = "/dev/shm/" + os.path.basename(file_name) + ".enc"
+        try:
+            fo = open(file_name, 'rb')
+        except:
+            print "[-] Error opening file {0} for reading.".format(file_name)
+            return
+
+        with fo:
             try:
-                plaintext = fo.read()
+                with self.open_private(out_file) as out:
+                    self.encrypt_stream(fo, out, key)
             except:
-                print "[-] Error opening file {0} for reading.".format(file_name)
+                print "[-] Error writing tmp file {0}".format(out_file)
+                # Never leave truncated ciphertext behind.
+                if os.path.exists(out_file):
+                    self.secure_delete(out_file, 10)
                 return
+        os.chmod(out_file, 0600)
 
-        enc = self.encrypt(plaintext, key)
-        with open("/dev/shm/" + os.path.basename(file_name) + ".enc", 'wb') as fo:
-            try:
-                fo.write(enc)
-            except:
-                print "[-] Error writing tmp file {0}".format("/dev/shm/" + os.path.basename(file_name) + ".enc")
-        os.chmod("/dev/shm/" + os.path.basename(file_name) + ".enc", 0600)
+        return out_file
 
-        return
+    def encrypt_stream(self, src, dst, key):
+        """
+        Encrypts src into dst a chunk at a time, so memory use is constant regardless of the file size. The output is
+        byte for byte the layout encrypt produces: a random IV followed by the AES CBC ciphertext of the PKCS#7 padded
+        input.
+        :param src: File object to read plaintext from.
+        :param dst: File object to write ciphertext to.
+        :param key: Key to be used for encryption
+        """
+        iv = os.urandom(AES.block_size)
+        cipher = AES.new(key, AES.MODE_CBC, iv, segment_size=64)
+        dst.write(iv)
+
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        # Plaintext left over from a short read that doesn't fill a whole block.
+        carry = ''
+        while True:
+            n = self._readinto(src, buf, view)
+            if not n:
+                break
+            data = carry + view[:n].tobytes() if carry else view[:n].tobytes()
+            whole = len(data) - len(data) % AES.block_size
+            carry = data[whole:]
+            if whole:
+                dst.write(cipher.encrypt(data[:whole]))
+
+        dst.write(cipher.encrypt(self.pkcs7_pad(carry)))
 
     def exists_on_s3(self, name, file_name):
         """
@@ -279,6 +497,15 @@ class kms3(object):
 
         return False
 
+    def open_private(self, path):
+        """
+        Opens a file for binary writing that is only readable by the owner from the moment it is created.
+        :param path: Path of the file.
+        :return: File object.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        return os.fdopen(fd, 'wb')
+
     def secure_delete(self, path, passes=1):
         """
         :param path: Path to object to securely wipe
@@ -459,20 +686,16 @@ class kms3(object):
         temp_data_key = self._get_data_key(name)
 
         if temp_data_key:
-            # AES-256 encrypt the file
-            self.encrypt_file(file_name, temp_data_key)
-
-            # Upload the file to s3
-            self.upload_to_s3(name, "/dev/shm/" + os.path.basename(file_name) + ".enc")
-
-            # Remove the file from /dev/shm securely
-            self.secure_delete("/dev/shm/" + os.path.basename(file_name) + ".enc", 10)
+            # AES-256 encrypt the file straight into an s3 multipart upload
+            if not self.encrypt_to_s3(name, file_name, temp_data_key):
+                print "[-] Encryption failed, {0} was not uploaded.".format(file_name)
+                return
 
             # Return the sha256sum of the original file for use in Chef's s3_file resource
-            file = open(file_name, "r")
-            file_data = file.read()
-            file_sha256_checksum = sha256(file_data)
-            file.close()
+            file_sha256_checksum = sha256()
+            with open(file_name, "rb") as file:
+                for chunk in iter(lambda: file.read(self.chunk_size), ''):
+                    file_sha256_checksum.update(chunk)
 
             print "[+] sha256sum for {0} is {1}".format(file_name, file_sha256_checksum.hexdigest())
 
@@ -502,6 +725,49 @@ class kms3(object):
         
         return text + binascii.unhexlify(output.getvalue())
 
+    def encrypt_to_s3(self, name, file_name, key):
+        """
+        Encrypts a file straight into a multipart upload to the cluster's bucket/prefix on s3. Nothing is staged in
+        /dev/shm, at most one part is held in memory, and files beyond the 5 GB single PUT limit can be stored.
+        The upload is aborted on any error, so a partial object never replaces the existing one.
+        :param name: Name of the cluster the file belongs to.
+        :param file_name: Full path of the local file to encrypt.
+        :param key: AES 256 key.
+        :return: True if the upload completed.
+        """
+        path = "cluster/" + name + "/" + os.path.basename(file_name) + ".enc"
+        try:
+            fo = open(file_name, 'rb')
+        except:
+            print "[-] Error opening file {0} for reading.".format(file_name)
+            return False
+
+        with fo:
+            # S3 allows at most 10000 parts per upload.
+            part_size = max(self.part_size, os.fstat(fo.fileno()).st_size / 9000 + 1)
+            try:
+                bucket = self.s3.get_bucket(self.__secrets_bucket__)
+                out = multipart_writer(bucket, path, part_size)
+            except Exception as e:
+                print "[-] Error starting upload to s3"
+                print e
+                return False
+
+            try:
+                self.encrypt_stream(fo, out, key)
+                out.close()
+            except Exception as e:
+                print "[-] Error encrypting and uploading {0}".format(file_name)
+                print e
+                try:
+                    out.abort()
+                except Exception:
+                    pass
+                return False
+
+        print "[+] Uploaded {0}".format("s3://" + self.__secrets_bucket__ + "/" + path)
+        return True
+
     def upload_to_s3(self, name, file_name):
         """
         Uploads file to an s3 bucket
@@ -525,6 +791,183 @@ class kms3(object):
 
         return
 
+class multipart_writer(object):
+    """
+    File-like object that sends everything written to it to s3 as a multipart upload, one part at a time.
+    """
+    def __init__(self, bucket, path, part_size):
+        self.upload = bucket.initiate_multipart_upload(path)
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self._send(self.part_size)
+
+    def _send(self, size):
+        self.parts += 1
+        self.upload.upload_part_from_file(StringIO.StringIO(str(self.buffer[:size])), self.parts)
+        del self.buffer[:size]
+
+    def close(self):
+        """
+        Sends the last part and completes the upload.
+        """
+        if self.buffer or not self.parts:
+            self._send(len(self.buffer))
+        self.upload.complete_upload()
+
+    def abort(self):
+        self.upload.cancel_upload()
+
+class locked_key(object):
+    """
+    A data key copied into a buffer that is mlock()ed so it is never swapped to disk, and zeroed when wiped.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    def __init__(self, key, expires):
+        self.size = len(key)
+        self.buffer = ctypes.create_string_buffer(self.size)
+        self.locked = self.libc.mlock(ctypes.addressof(self.buffer), ctypes.c_size_t(self.size)) == 0
+        if not self.locked:
+            print "[-] Warning: unable to lock key memory (errno {0})".format(ctypes.get_errno())
+        ctypes.memmove(self.buffer, key, self.size)
+        self.expires = expires
+
+    def value(self):
+        return self.buffer.raw[:self.size]
+
+    def wipe(self):
+        ctypes.memset(self.buffer, 0, self.size)
+        if self.locked:
+            self.libc.munlock(ctypes.addressof(self.buffer), ctypes.c_size_t(self.size))
+            self.locked = False
+
+class key_agent(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Local daemon that holds decrypted data keys in locked memory and hands them to kms3 clients over a Unix socket,
+    so scripts touching many files make one KMS call per cluster instead of one per operation. Keys are wiped once
+    their ttl passes. The socket is only accessible by the user running the agent.
+
+    Protocol, one request per connection:
+        GET <cluster>  ->  OK <base64 data key> | ERR <message>
+        FLUSH          ->  OK
+    """
+    daemon_threads = True
+
+    def __init__(self, path=AGENT_SOCKET, ttl=3600):
+        """
+        :param path: Path of the Unix socket to listen on.
+        :param ttl: Seconds a data key is held before it is wiped.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        # Keys are fetched without the process cache so they only live in locked memory.
+        self.api = kms3(key_ttl=0)
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        info = os.stat(directory)
+        if info.st_uid != os.getuid() or info.st_mode & 077:
+            raise ValueError("Socket directory {0} must be owned by this user with mode 0700".format(directory))
+
+        if os.path.exists(path):
+            os.remove(path)
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, key_agent_handler)
+        finally:
+            os.umask(umask)
+
+    def get(self, name):
+        """
+        Returns the data key for a cluster, fetching it with KMS if it isn't held or has expired.
+        """
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(name, threading.Lock())
+
+        # One fetch per cluster even when many clients ask at once.
+        with fetch_lock:
+            with self.lock:
+                held = self.keys.get(name)
+                if held and held.expires > time.time():
+                    return held.value()
+
+            decrypted_key = self.api._get_data_key(name)
+            if not decrypted_key:
+                return
+
+            with self.lock:
+                if name in self.keys:
+                    self.keys.pop(name).wipe()
+                self.keys[name] = locked_key(decrypted_key, time.time() + self.ttl)
+            return decrypted_key
+
+    def expire(self):
+        """
+        Wipes every key whose ttl has passed.
+        """
+        with self.lock:
+            for name, held in self.keys.items():
+                if held.expires <= time.time():
+                    held.wipe()
+                    del self.keys[name]
+
+    def flush(self):
+        """
+        Wipes every held key.
+        """
+        with self.lock:
+            for held in self.keys.values():
+                held.wipe()
+            self.keys.clear()
+
+    def run(self):
+        """
+        Serves clients until interrupted, expiring keys in the background, then wipes every key.
+        """
+        def sweep():
+            while True:
+                time.sleep(min(60, self.ttl))
+                self.expire()
+
+        thread = threading.Thread(target=sweep)
+        thread.daemon = True
+        thread.start()
+
+        print "[+] Key agent listening on {0}".format(self.path)
+        print "[+] export {0}={1}".format(AGENT_SOCKET_ENV, self.path)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.flush()
+            self.server_close()
+            os.remove(self.path)
+
+class key_agent_handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        command, _, name = self.rfile.readline().strip().partition(" ")
+        if command == "GET" and name:
+            decrypted_key = self.server.get(name)
+            if decrypted_key:
+                self.wfile.write("OK " + base64.b64encode(decrypted_key) + "\n")
+            else:
+                self.wfile.write("ERR unable to get data key for " + name + "\n")
+        elif command == "FLUSH":
+            self.server.flush()
+            self.wfile.write("OK\n")
+        else:
+            self.wfile.write("ERR unknown command\n")
+
 def main():
     parser = argparse.ArgumentParser(description='kms3.py ',
                                      formatter_class=RawTextHelpFormatter)
@@ -552,9 +995,19 @@ def main():
     create_parser.add_argument('--file', help='Full path of the local file to upload.',
                                 required=True)
 
+    create_parser = subparsers.add_parser('agent', help='Runs a key agent that holds data keys in locked memory and serves them to\n'
+                                                        'kms3 over a Unix socket. Clients use it when ' + AGENT_SOCKET_ENV + ' is set.')
+    create_parser.set_defaults(operation='agent')
+    create_parser.add_argument('--socket', help='Path of the agent socket.', default=AGENT_SOCKET)
+    create_parser.add_argument('--ttl', type=int, help='Seconds a data key is held before it is wiped.', default=3600)
+
     args = vars(parser.parse_args())
 
-    api = kms3()
+    if args['operation'] == "agent":
+        key_agent(args['socket'], args['ttl']).run()
+        return
+
+    api = kms3(agent_socket=os.environ.get(AGENT_SOCKET_ENV))
 
     if args['operation'] == "edit":
         api.edit(args['name'], args['file'])
@@ -9,103 +9,1055 @@ via Chef, and creates AMI images for the resulting node builds for use with ASGA
 import chef
 import boto
 import sys
-import copy
+import os
+import re
+import json
 import time
 import pprint
+import random
+import errno
+import socket
+import urllib
+import argparse
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
+from hashlib import sha256
+from multiprocessing.pool import ThreadPool
 from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
 from boto import utils
 # Globals
 imageId='ami-04fe926c'
 failed_ids = []
+# Number of ids OR'ed together in a single Chef search query.
+search_chunk = 50
+# Number of ids sent in a single EC2 request or filter.
+ec2_chunk = 200
+# Image names written by create_images: <cluster>-autoscale-<YYYY-mm-dd-HH-MM-SS>
+autoscale_name = re.compile(r'^(?P<cluster>.+)-autoscale-(?P<timestamp>\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})$')
+# Image tag holding the fingerprint of the build inputs an image was made from.
+fingerprint_tag = 'autobuild-fingerprint'
+# Node attributes fetched by partial search, as result key => attribute path. Avoids pulling the full ohai payload.
+node_keys = {'name': ['name'], 'cluster': ['cluster'], 'roles': ['roles'], 'userdata': ['ec2', 'userdata'],
+             'security_groups': ['ec2', 'security_groups'], 'instance_id': ['ec2', 'instance_id'],
+             'reservation_id': ['ec2', 'reservation_id']}
+# Attributes the node cache is indexed on for find_nodes.
+node_index_keys = ('instance_id', 'reservation_id')
+# Cluster states that need no further work.
+finished_states = ('done', 'failed', 'skipped', 'remote')
+# Default location of the run journal used by --resume.
+journal_path = os.path.expanduser('~/.mass-asg-rebuild/journal.json')
+# EC2 error codes retried with backoff. Throttling also slows down the shared rate limiter.
+throttle_codes = ('RequestLimitExceeded', 'Throttling')
+# EC2 error codes for launches requeued by the scheduler, and how many launch attempts a cluster gets.
+capacity_codes = ('InsufficientInstanceCapacity',)
+launch_attempts = 8
+
+# Serializes output from worker threads so lines never interleave.
+output_lock = threading.Lock()
+
+def say(line):
+    """
+    Prints a line. Safe to call from pool and heartbeat threads.
+    """
+    with output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+class rate_limiter(object):
+    """
+    Token bucket shared by every EC2 call. The rate is halved whenever EC2 throttles us and grows back slowly while
+    calls succeed, so the run settles near the highest rate the account allows.
+    """
+    def __init__(self, rate=5.0, max_rate=20.0, min_rate=0.5):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = min_rate
+        self.tokens = 1.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+class metrics(object):
+    """
+    Collects per-cluster phase timings, API call counts and latency histograms, and retry/throttle counters for a
+    run. Written out as a JSON report and optionally as a Chrome trace (chrome://tracing) timeline.
+    """
+    # Upper bounds, in seconds, of the latency histogram buckets. The last bucket is unbounded.
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-class asg(object):
     def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.open = {}
+        self.calls = {}
+        self.retries = defaultdict(int)
+        self.waits = defaultdict(list)
+
+    def begin(self, track, phase):
+        """
+        Starts a phase on a track (a cluster name, or 'run' for global phases), ending the track's previous phase.
+        """
+        now = time.time()
+        with self.lock:
+            self._close(track, now)
+            self.open[track] = (phase, now)
+
+    def end(self, track):
+        with self.lock:
+            self._close(track, time.time())
+
+    def _close(self, track, now):
+        if track in self.open:
+            phase, start = self.open.pop(track)
+            self.spans.append((track, phase, start, now))
+
+    def call(self, service, operation, seconds, error=False):
+        """
+        Records one API call and its latency.
+        """
+        key = service + '.' + operation
+        with self.lock:
+            stats = self.calls.setdefault(key, {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                                                'histogram': [0] * (len(self.buckets) + 1)})
+            stats['count'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            bucket = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    bucket = i
+                    break
+            stats['histogram'][bucket] += 1
+
+    def wait(self, kind, key, seconds, outcome):
+        """
+        Records how long a resource was waited on and how the wait ended.
+        """
+        with self.lock:
+            self.waits[kind].append({'id': key, 'seconds': seconds, 'outcome': outcome})
+
+    def retry(self, service, operation, code):
+        with self.lock:
+            self.retries[service + '.' + operation + ':' + str(code)] += 1
+
+    @contextmanager
+    def timed(self, service, operation):
+        """
+        Times the enclosed API call.
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.call(service, operation, time.time() - start, error=True)
+            raise
+        self.call(service, operation, time.time() - start)
+
+    def report(self):
+        with self.lock:
+            spans = list(self.spans)
+            calls = dict(self.calls)
+            retries = dict(self.retries)
+            waits = dict(self.waits)
+
+        phases = defaultdict(lambda: {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+        tracks = defaultdict(list)
+        for track, phase, start, end in spans:
+            tracks[track].append({'phase': phase, 'start': start - self.start, 'seconds': end - start})
+            if track != 'run':
+                phases[phase]['count'] += 1
+                phases[phase]['total_seconds'] += end - start
+                phases[phase]['max_seconds'] = max(phases[phase]['max_seconds'], end - start)
+
+        return {'started': self.start, 'seconds': time.time() - self.start,
+                'histogram_buckets': list(self.buckets) + ['+Inf'], 'calls': calls, 'retries': retries, 'waits': waits,
+                'phases': phases, 'run': tracks.pop('run', []), 'clusters': tracks}
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def write_trace(self, path):
+        """
+        Writes every phase as a complete ('X') event in Chrome trace format, one thread per cluster.
+        """
+        with self.lock:
+            spans = list(self.spans)
+
+        tids = {}
+        events = []
+        for track, phase, start, end in spans:
+            tid = tids.setdefault(track, len(tids))
+            events.append({'name': phase, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': int((start - self.start) * 1e6), 'dur': int((end - start) * 1e6)})
+        for track, tid in tids.iteritems():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': track}})
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+class waiter(object):
+    """
+    Waits on many resources of one kind at once. Every check polls all pending resources with a single batched call.
+    Between checks the interval backs off with jitter while nothing is expected to finish, and drops to the minimum
+    once resources reach the typical completion time seen so far. Each resource has its own deadline, and its wait
+    time is recorded when it completes, fails or times out.
+    """
+    def __init__(self, kind, poll, stats=None, expected=None, min_interval=3, max_interval=60):
+        """
+        :param kind: Name of the resource kind, used in output and metrics. Ex. build, stop, image
+        :param poll: Function taking a list of keys and returning (dict of completed key => value, set of failed keys).
+        :param expected: Initial guess, in seconds, of how long a resource takes to complete.
+        """
+        self.kind = kind
+        self.poll = poll
+        self.stats = stats
+        self.expected = expected
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.next_poll = time.time()
+        self.pending = {}
+        self.durations = []
+
+    def add(self, key, item, deadline):
+        """
+        Starts tracking a resource.
+        :param key: Id passed to the poll function.
+        :param item: Object handed back when the resource completes, fails or times out.
+        :param deadline: Time by which the resource must complete.
+        """
+        if not self.pending:
+            self.interval = self.min_interval
+            self.next_poll = time.time() + self.interval
+        self.pending[key] = (item, time.time(), deadline)
+
+    def remove(self, key):
+        """
+        Stops tracking a resource without recording an outcome.
+        """
+        self.pending.pop(key, None)
+
+    def due(self):
+        return bool(self.pending) and time.time() >= self.next_poll
+
+    def _expected(self):
+        if self.durations:
+            return sorted(self.durations)[len(self.durations) / 2]
+        return self.expected
+
+    def _finish(self, key, outcome):
+        item, started, deadline = self.pending.pop(key)
+        waited = time.time() - started
+        if outcome == 'completed':
+            self.durations.append(waited)
+        if self.stats:
+            self.stats.wait(self.kind, key, waited, outcome)
+        print "{0} {1} {2} after {3:.0f}s".format(key, self.kind, outcome, waited)
+        return item
+
+    def check(self):
+        """
+        Polls every pending resource once and schedules the next poll.
+        :return: Tuple of (list of (item, value) completed, list of items failed, list of items timed out).
+        """
+        keys = self.pending.keys()
+        try:
+            completed, failed = self.poll(keys)
+        except Exception as e:
+            print "Failed to poll {0} status.".format(self.kind)
+            print e
+            completed, failed = {}, set()
+
+        now = time.time()
+        done = [(self._finish(key, 'completed'), value) for key, value in completed.items() if key in self.pending]
+        errors = [self._finish(key, 'failed') for key in failed if key in self.pending]
+        timed_out = [self._finish(key, 'timed out') for key, (item, started, deadline) in self.pending.items()
+                     if now >= deadline]
+
+        expected = self._expected()
+        if expected and any(now - started >= expected * 0.8 for item, started, deadline in self.pending.values()):
+            # Something should finish any moment now.
+            self.interval = self.min_interval
+        elif done or errors:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+        # Never sleep past the nearest deadline.
+        delay = self.interval * random.uniform(0.8, 1.2)
+        if self.pending:
+            delay = min(delay, max(0, min(deadline for item, started, deadline in self.pending.values()) - now))
+        self.next_poll = now + delay
+
+        return done, errors, timed_out
+
+class throttled_connection(object):
+    """
+    Wraps an EC2 connection so every API call goes through the shared rate limiter and is retried with exponential
+    backoff and jitter on throttling errors. Insufficient capacity errors are raised straight away; waiting minutes
+    for capacity here would stall every other cluster, so run() requeues the launch instead.
+    """
+    def __init__(self, connection, limiter, retries=8, stats=None):
+        self.connection = connection
+        self.limiter = limiter
+        self.retries = retries
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            for attempt in range(self.retries + 1):
+                self.limiter.acquire()
+                start = time.time()
+                try:
+                    result = attr(*args, **kwargs)
+                    self.limiter.succeeded()
+                    if self.stats:
+                        self.stats.call('ec2', name, time.time() - start)
+                    return result
+                except Exception as e:
+                    if self.stats:
+                        self.stats.call('ec2', name, time.time() - start, error=True)
+                    code = getattr(e, 'error_code', None)
+                    if attempt == self.retries or code not in throttle_codes:
+                        raise
+
+                    if self.stats:
+                        self.stats.retry('ec2', name, code)
+
+                    self.limiter.throttled()
+                    delay = random.uniform(0.5, 1.0) * min(30, 2 ** attempt)
+                    say("{0} returned {1}, retrying in {2:.1f}s".format(name, code, delay))
+                    time.sleep(delay)
+
+        return call
+
+class cluster_build(object):
+    """
+    Tracks one cluster through its build -> stop -> image -> terminate pipeline.
+    States: queued, building, stopping, imaging, done, failed, skipped, remote (finished by another worker).
+    """
+    def __init__(self, name, env, role, security_groups):
+        self.name = name
+        self.env = env
+        self.role = role
+        self.security_groups = security_groups
+        self.state = 'queued'
+        self.reservation_id = None
+        self.instance_id = None
+        self.node_name = None
+        self.ami_id = None
+        # Time by which the current state must complete.
+        self.deadline = None
+        self.terminated = False
+        self.fingerprint = None
+        # Launch attempts so far, and the earliest time of the next one after an insufficient capacity error.
+        self.launch_attempts = 0
+        self.not_before = None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data):
+        build = cls(data['name'], data['env'], data['role'], data['security_groups'])
+        build.__dict__.update(data)
+        return build
+
+class journal(object):
+    """
+    Durable record of a run: the image timestamp, failed ids and every cluster's state and AWS ids. It is rewritten
+    atomically at each checkpoint so an interrupted run can be resumed without launching duplicate builds.
+    """
+    def __init__(self, path=journal_path):
+        self.path = path
+
+    def load(self):
+        """
+        Returns (timestamp, builds, failed_ids) from the journal, or None if there is no journal.
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path) as f:
+            data = json.load(f)
+
+        return data['timestamp'], [cluster_build.from_dict(build) for build in data['clusters']], data['failed_ids']
+
+    def save(self, timestamp, builds):
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        data = {'timestamp': timestamp, 'image_id': imageId, 'failed_ids': failed_ids,
+                'clusters': [build.to_dict() for build in builds]}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+class file_leases(object):
+    """
+    Cluster leases stored as one JSON file per cluster in a directory shared by every worker (local disk or NFS).
+    A lease is created with O_EXCL so only one worker can claim a free cluster, and an expired lease is taken over by
+    atomically renaming it out of the way first, so only one worker wins the takeover.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.lease')
+
+    def read(self, name):
+        """
+        Returns the lease record for a cluster, or None if it has no lease.
+        """
+        try:
+            with open(self._path(name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def create(self, name, lease):
+        """
+        Creates a lease if the cluster has none. Returns True if this call created it.
+        """
+        try:
+            fd = os.open(self._path(name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        with os.fdopen(fd, 'w') as f:
+            json.dump(lease, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def replace(self, name, expected, lease):
+        """
+        Replaces the lease `expected` with a new one. Returns False if the lease changed in the meantime.
+        """
+        current = self.read(name)
+        if current != expected:
+            return False
+
+        if expected['owner'] != lease['owner']:
+            # Takeover: only the worker whose rename succeeds may create the new lease.
+            stale = '{0}.{1}'.format(self._path(name), lease['owner'])
+            try:
+                os.rename(self._path(name), stale)
+            except OSError:
+                return False
+            try:
+                with open(stale) as f:
+                    moved = json.load(f)
+            except (IOError, ValueError):
+                moved = None
+            if moved != expected:
+                # Another worker took the lease over between our read and rename; put its lease back.
+                try:
+                    os.link(stale, self._path(name))
+                except OSError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            return self.create(name, lease)
+
+        tmp = '{0}.{1}.tmp'.format(self._path(name), lease['owner'])
+        with open(tmp, 'w') as f:
+            json.dump(lease, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._path(name))
+        return True
+
+class s3_leases(object):
+    """
+    Cluster leases stored as one JSON object per cluster under an S3 prefix. Writes are conditional: a new lease is
+    only created if the object doesn't exist (If-None-Match), and a lease is only replaced if it still has the ETag
+    it had when it was read (If-Match), so of two workers racing for a cluster exactly one wins.
+    """
+    def __init__(self, bucket, prefix='mass-asg-rebuild/leases'):
+        self.bucket = boto.connect_s3().get_bucket(bucket)
+        self.prefix = prefix.strip('/')
+        self.lock = threading.Lock()
+        # Lease name => (ETag, lease token) of the last version read or written.
+        self.etags = {}
+
+    def _key(self, name):
+        return '{0}/{1}.lease'.format(self.prefix, name)
+
+    def read(self, name):
+        key = self.bucket.get_key(self._key(name))
+        if key is None:
+            return None
+        try:
+            lease = json.loads(key.get_contents_as_string())
+        except ValueError:
+            return None
+        with self.lock:
+            self.etags[name] = (key.etag, lease.get('token'))
+        return lease
+
+    def _put(self, name, lease, headers):
+        """
+        Conditionally writes a lease. Returns False if the precondition failed.
+        """
+        key = self.bucket.new_key(self._key(name))
+        try:
+            key.set_contents_from_string(json.dumps(lease), headers=headers)
+        except Exception as e:
+            # 412 Precondition Failed, or 409 when a concurrent conditional write is in progress.
+            if getattr(e, 'status', None) in (409, 412):
+                return False
+            raise
+        with self.lock:
+            self.etags[name] = (key.etag, lease['token'])
+        return True
+
+    def create(self, name, lease):
+        return self._put(name, lease, {'If-None-Match': '*'})
+
+    def replace(self, name, expected, lease):
+        with self.lock:
+            etag, token = self.etags.get(name, (None, None))
+        if token != expected.get('token'):
+            if self.read(name) != expected:
+                return False
+            with self.lock:
+                etag, token = self.etags[name]
+        return self._put(name, lease, {'If-Match': etag})
+
+class lease_manager(object):
+    """
+    Claims clusters for this worker so several mass-asg-rebuild processes can share one fleet-wide rebuild without
+    launching any cluster twice. The store is scoped to a single run, so leases finished by one run don't carry over
+    to the next. Each lease carries the cluster's latest state, so when a worker dies and its leases
+    expire, the worker that takes over re-attaches to the in-flight build, stop or image instead of starting over.
+    Held leases are renewed by a heartbeat thread; finished clusters keep a lease marked finished so they are never
+    claimed again.
+    """
+    def __init__(self, store, owner=None, ttl=600):
+        """
+        :param store: file_leases or s3_leases instance.
+        :param owner: Worker id. Reusing the same id after a restart reclaims this worker's leases immediately.
+        :param ttl: Seconds a lease stays valid without a heartbeat.
+        """
+        self.store = store
+        self.owner = owner or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Serializes renew() between the heartbeat thread and checkpoints, which share the held lease snapshots.
+        self.renew_lock = threading.Lock()
+        # Cluster name => (cluster_build, lease record last written).
+        self.held = {}
+        # (cluster_build, adopted) pairs for leases lost to another worker; adopted is True when the new owner
+        # carried on with this worker's reservation.
+        self.lost = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _lease(self, build, finished=False):
+        return {'owner': self.owner, 'token': '{0:x}'.format(random.getrandbits(64)),
+                'expires': time.time() + self.ttl, 'finished': finished, 'cluster': build.to_dict()}
+
+    def claim(self, build):
+        """
+        Tries to claim a cluster.
+        :return: 'claimed' if this worker now holds it (adopting the state left by a dead worker, if any), 'held' if
+                 another live worker holds it, or 'finished' if it was already finished in this run.
+        """
+        try:
+            current = self.store.read(build.name)
+            if current is None:
+                lease = self._lease(build)
+                if not self.store.create(build.name, lease):
+                    return 'held'
+            elif current['finished']:
+                return 'finished'
+            elif current['owner'] != self.owner and current['expires'] > time.time():
+                return 'held'
+            else:
+                state = current['cluster']
+                if current['owner'] != self.owner:
+                    print "{0}: taking over from {1} ({2})".format(build.name, current['owner'], state['state'])
+                if state['state'] != 'queued':
+                    build.__dict__.update(state)
+                lease = self._lease(build)
+                if not self.store.replace(build.name, current, lease):
+                    return 'held'
+        except Exception as e:
+            print "Failed to claim lease for {0}".format(build.name)
+            print e
+            return 'held'
+
+        with self.lock:
+            self.held[build.name] = (build, lease)
+        return 'claimed'
+
+    def renew(self, force=False):
+        """
+        Rewrites every held lease whose cluster state changed (or all of them when forced) and releases finished
+        clusters. Leases found to be owned by another worker are moved to self.lost.
+        """
+        with self.renew_lock:
+            self._renew(force)
+
+    def _renew(self, force):
+        with self.lock:
+            held = self.held.items()
+
+        for name, (build, lease) in held:
+            finished = build.state in finished_states
+            if not force and not finished and lease['cluster'] == build.to_dict():
+                continue
+            update = self._lease(build, finished=finished)
+            try:
+                renewed = self.store.replace(name, lease, update)
+            except Exception as e:
+                say("Failed to renew lease for {0}".format(name))
+                say(str(e))
+                continue
+
+            adopted = False
+            if not renewed:
+                try:
+                    current = self.store.read(name)
+                    adopted = bool(current and build.reservation_id and
+                                   current['cluster'].get('reservation_id') == build.reservation_id)
+                except Exception as e:
+                    say("Failed to read lease for {0}".format(name))
+                    say(str(e))
+
+            with self.lock:
+                if not renewed:
+                    say("Lost lease for {0}".format(name))
+                    self.lost.append((build, adopted))
+                    del self.held[name]
+                elif finished:
+                    del self.held[name]
+                else:
+                    self.held[name] = (build, update)
+
+    def confirm(self, build):
+        """
+        Re-reads a held lease right before acting on it. A lease that is no longer this worker's is forgotten.
+        :return: True if this worker still holds the cluster.
+        """
+        with self.lock:
+            held = self.held.get(build.name)
+        if not held:
+            return False
+        try:
+            current = self.store.read(build.name)
+        except Exception as e:
+            say("Failed to read lease for {0}".format(build.name))
+            say(str(e))
+            return False
+        if current and current['owner'] == self.owner and current['token'] == held[1]['token']:
+            return True
+
+        with self.lock:
+            self.held.pop(build.name, None)
+        return False
+
+    def take_lost(self):
+        """
+        Returns and forgets the (cluster_build, adopted) pairs whose leases were lost since the last call.
+        """
+        with self.lock:
+            lost, self.lost = self.lost, []
+        return lost
+
+    def start(self):
+        """
+        Starts the heartbeat thread.
+        """
+        def heartbeat():
+            while not self.stopped.wait(self.ttl / 3.0):
+                self.renew(force=True)
+
+        self.thread = threading.Thread(target=heartbeat)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.renew()
+
+class asg(object):
+    def __init__(self, rate=5.0, max_rate=20.0):
+        self.metrics = metrics()
         self.api = chef.autoconfigure()
         self.bag = chef.DataBag('clusters')
         try:
-            self.ec2 = boto.connect_ec2()
+            self.ec2 = throttled_connection(boto.connect_ec2(), rate_limiter(rate, max_rate), stats=self.metrics)
         except Exception as e:
             print e
         self.threshold = 2400
+        self.workers = 10
+        self.timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+        self.journal = None
+        self.leases = None
+        # Per-run cache of node name => partial search attributes, indexed by ec2 id.
+        self.nodes = {}
+        self.node_index = dict((key, {}) for key in node_index_keys)
+        # Per-run caches of Chef objects used for fingerprints.
+        self.roles = {}
+        self.cookbook_versions = None
+        self.cookbook_dependencies = {}
 
-    def cleanup(self, instance_ids, terminate=True):
+    def search_nodes(self, query, rows=1000):
         """
-        Deletes the build nodes and clients out of the Chef server.
-        Also terminates all instances that were launched as a result of the build.
-        :param instances_ids: List of instance ids to terminate
+        Runs a Chef partial search for nodes, following pages until every row has been returned. Only the attributes
+        in node_keys are returned, and every node seen is added to the node cache.
+        :param query: Solr query string.
+        :param rows: Page size.
+        :return: Generator of dicts of node_keys => attribute value.
         """
+        start = 0
+        while True:
+            path = '/search/node?' + urllib.urlencode({'q': query, 'rows': rows, 'start': start})
+            with self.metrics.timed('chef', 'partial_search'):
+                results = self.api.api_request('POST', path, data=node_keys)
+            for row in results['rows']:
+                node = row['data']
+                self.remember(node)
+                yield node
 
-        for instance in instance_ids:
-            self.terminate(instance)
+            start += len(results['rows'])
+            if len(results['rows']) == 0 or start >= results['total']:
+                break
 
-        for row in chef.Search('node', 'name:*.internal'):
-            node = chef.Node(row.object.name)
-            chef.Node.delete(node)
-
-    def stop_servers(self, instance_ids):
+    def remember(self, node):
         """
-        Stops instances specified in list. It will also stop any servers listed in failed_ids as a cleanup measure.
-        :param instances_ids: List of instance ids to stop
+        Adds a node's partial search attributes to the node cache.
         """
+        self.nodes[node['name']] = node
+        for key in node_index_keys:
+            if node.get(key):
+                self.node_index[key][node[key]] = node
 
-        status = 0
-        stopped = []
+    def find_nodes(self, attribute, ids):
+        """
+        Finds the stage nodes whose ec2 attribute matches any of the supplied ids. Ids already in the node cache are
+        answered from it; the rest are looked up with one combined search (chunked to keep the query a sane length)
+        instead of one search per id.
+        :param attribute: ec2 attribute to match. Ex. reservation_id or instance_id
+        :param ids: List of ids.
+        :return: Dict of id => dict of node_keys => attribute value.
+        """
+        index = self.node_index[attribute]
+        nodes = dict((value, index[value]) for value in ids if value in index)
+        missing = [value for value in ids if value not in index]
+        for i in range(0, len(missing), search_chunk):
+            query = " OR ".join("ec2_" + attribute + ":" + value for value in missing[i:i + search_chunk])
+            for node in self.search_nodes("chef_environment:stage AND (" + query + ")"):
+                nodes[node[attribute]] = node
 
-        print "-------------------------------"
-        print "Stopping instances"
-        print "-------------------------------"
+        return nodes
 
-        for instance_id in instance_ids:
+    def get_images(self, ami_ids):
+        """
+        Describes many images with one DescribeImages call per chunk of ids. Uses an image-id filter so an image that
+        isn't visible yet doesn't fail the whole call.
+        :param ami_ids: List of ami ids.
+        :return: List of images.
+        """
+        images = []
+        for i in range(0, len(ami_ids), ec2_chunk):
             try:
-                self.ec2.create_tags(instance_id, {"Name": "chef-autobuild"})
+                images.extend(self.ec2.get_all_images(filters={'image-id': ami_ids[i:i + ec2_chunk]}))
             except Exception as e:
-                print "Failed to add tag for {0}".format(instance_id)
+                print "Failed to describe images."
+                print e
 
-            time.sleep(1)
+        return images
 
+    def get_instances(self, instance_ids):
+        """
+        Describes many instances with one DescribeInstances call per chunk of ids. Uses an instance-id filter so an
+        id that isn't visible yet doesn't fail the whole call.
+        :param instance_ids: List of instance ids.
+        :return: List of instances.
+        """
+        instances = []
+        for i in range(0, len(instance_ids), ec2_chunk):
             try:
-                self.ec2.stop_instances(instance_id.encode('ascii'))
+                reservations = self.ec2.get_all_instances(filters={'instance-id': instance_ids[i:i + ec2_chunk]})
             except Exception as e:
-                print "Failed to issue stop command for {0}".format(instance_id.encode('ascii'))
+                print "Failed to describe instances."
                 print e
+                continue
+            instances.extend(instance for r in reservations for instance in r.instances)
+
+        return instances
+
+    def expand_run_list(self, run_list, roles, cookbooks):
+        """
+        Recursively expands a run list, collecting the roles it pulls in and the cookbooks its recipes come from.
+        :param run_list: List of run list items. Ex. ["role[base]", "recipe[apache2::mod_ssl]"]
+        :param roles: Dict filled with role name => role inputs.
+        :param cookbooks: Set filled with cookbook names.
+        """
+        for item in run_list:
+            if item.startswith('role['):
+                name = item[5:-1]
+                if name in roles:
+                    continue
+
+                if name not in self.roles:
+                    with self.metrics.timed('chef', 'role'):
+                        role = chef.Role(name)
+                    self.roles[name] = {'run_list': list(role.run_list),
+                                        'env_run_list': list(role.env_run_lists.get('stage', [])),
+                                        'default_attributes': dict(role.default_attributes),
+                                        'override_attributes': dict(role.override_attributes)}
+                roles[name] = self.roles[name]
+                self.expand_run_list(roles[name]['env_run_list'] or roles[name]['run_list'], roles, cookbooks)
+            else:
+                recipe = item[7:-1] if item.startswith('recipe[') else item
+                cookbooks.add(recipe.split('::')[0].split('@')[0])
 
+    def resolve_cookbooks(self, cookbooks):
+        """
+        Resolves cookbooks and their metadata dependencies to the newest versions available to the stage environment.
+        :param cookbooks: Set of cookbook names.
+        :return: Dict of cookbook => version.
+        """
+        if self.cookbook_versions is None:
+            with self.metrics.timed('chef', 'environment_cookbooks'):
+                data = self.api['/environments/stage/cookbooks?num_versions=1']
+            self.cookbook_versions = dict((name, info['versions'][0]['version'])
+                                          for name, info in data.iteritems() if info['versions'])
+
+        resolved = {}
+        pending = list(cookbooks)
+        while pending:
+            name = pending.pop()
+            if name in resolved or name not in self.cookbook_versions:
+                continue
+
+            version = self.cookbook_versions[name]
+            resolved[name] = version
+            if (name, version) not in self.cookbook_dependencies:
+                with self.metrics.timed('chef', 'cookbook'):
+                    metadata = self.api['/cookbooks/{0}/{1}'.format(name, version)].get('metadata', {})
+                self.cookbook_dependencies[(name, version)] = metadata.get('dependencies', {}).keys()
+            pending.extend(self.cookbook_dependencies[(name, version)])
+
+        return resolved
+
+    def fingerprint(self, build):
+        """
+        Computes a fingerprint of everything that goes into a cluster's image: the base AMI, the role and its expanded
+        run list and attributes, and the cookbook versions that run list resolves to.
+        :param build: cluster_build object.
+        :return: Hex sha256 digest.
+        """
+        roles = {}
+        cookbooks = set()
+        self.expand_run_list(['role[' + build.role + ']'], roles, cookbooks)
+
+        inputs = {'image_id': imageId, 'env': build.env, 'role': build.role, 'roles': roles,
+                  'cookbooks': self.resolve_cookbooks(cookbooks)}
+        return sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def fingerprint_builds(self, builds, skip=True):
+        """
+        Fingerprints every cluster's build inputs and, when skip is set, marks clusters whose fingerprint matches the
+        one tagged on their newest image as skipped.
+        :param builds: List of queued cluster_build objects.
+        :param skip: Skip unchanged clusters. False rebuilds everything but still records fingerprints.
+        """
+        print "-------------------------------"
+        print "Checking build fingerprints"
+        print "-------------------------------"
+
+        latest = {}
         try:
-            reservations = self.ec2.get_all_reservations(filters={'reservation_id':failed_ids})
+            for image in self.ec2.get_all_images(owners=['self'], filters={'name': '*-autoscale-*'}):
+                match = autoscale_name.match(image.name or '')
+                if match and image.state == 'available':
+                    cluster = match.group('cluster')
+                    if cluster not in latest or match.group('timestamp') > latest[cluster][0]:
+                        latest[cluster] = (match.group('timestamp'), image)
         except Exception as e:
-            print "Failed to get instance reservations."
+            print "Failed to get existing autoscale images."
             print e
 
-        instances = [i for r in reservations for i in r.instances]
+        for build in builds:
+            try:
+                build.fingerprint = self.fingerprint(build)
+            except Exception as e:
+                print "Failed to fingerprint {0}, rebuilding it.".format(build.name)
+                print e
+                continue
+
+            newest = latest.get(build.name)
+            if skip and newest and newest[1].tags.get(fingerprint_tag) == build.fingerprint:
+                print "{0} unchanged since {1}, skipping.".format(build.name, newest[1].id)
+                self.transition(build, 'skipped')
+                build.ami_id = newest[1].id
+
+    def cleanup(self, builds):
+        """
+        Terminates the build instances of this run that are still around, in batched calls, and deletes the Chef nodes
+        and clients those builds registered. Only nodes tracked for this run are touched, and clusters handed over to
+        another worker are left to it.
+        :param builds: List of cluster_build objects.
+        """
+
+        print "-------------------------------"
+        print "Cleaning up"
+        print "-------------------------------"
 
-        for instance in instances:
+        owned = [build for build in builds if build.state != 'remote']
+        remaining = [build for build in owned if build.instance_id and not build.terminated]
+        for i in range(0, len(remaining), ec2_chunk):
+            chunk = remaining[i:i + ec2_chunk]
+            if self.terminate([build.instance_id for build in chunk]):
+                for build in chunk:
+                    build.terminated = True
+
+        # Builds that timed out may have registered with Chef after we stopped looking for them.
+        unresolved = [build for build in owned if build.reservation_id and not build.node_name]
+        if unresolved:
             try:
-                self.ec2.create_tags(instance.id, {"Name": "chef-autobuild"})
+                nodes = self.find_nodes('reservation_id', [build.reservation_id for build in unresolved])
             except Exception as e:
-                print "Failed to add tag for {0}".format(instance.id)
+                print "Failed to search Chef for timed out builds."
+                print e
+                nodes = {}
+            for build in unresolved:
+                if build.reservation_id in nodes:
+                    build.node_name = nodes[build.reservation_id]['name']
+
+        def delete(name):
+            for kind, cls in (('node', chef.Node), ('client', chef.Client)):
+                try:
+                    with self.metrics.timed('chef', kind + '_delete'):
+                        cls(name, skip_load=True).delete()
+                    say("Deleted Chef {0} {1}".format(kind, name))
+                except Exception as e:
+                    say("Failed to delete Chef {0} {1}".format(kind, name))
+                    say(str(e))
+
+        names = [build.node_name for build in owned if build.node_name]
+        if names:
+            pool = ThreadPool(min(self.workers, len(names)))
+            try:
+                pool.map(delete, names)
+            finally:
+                pool.close()
+                pool.join()
+
+        self.checkpoint(builds)
 
-                time.sleep(1)
+    def stop_servers(self, builds):
+        """
+        Tags and stops the build instances of the supplied clusters with batched requests and moves them to the
+        stopping state.
+        :param builds: List of cluster_build objects whose Chef build has completed.
+        """
+        instance_ids = [build.instance_id for build in builds]
+        for i in range(0, len(instance_ids), ec2_chunk):
+            chunk = instance_ids[i:i + ec2_chunk]
+            try:
+                self.ec2.create_tags(chunk, {"Name": "chef-autobuild"})
+            except Exception as e:
+                print "Failed to add tags for {0}".format(", ".join(chunk))
+                print e
 
             try:
-                self.ec2.stop_instances(instance.id)
+                self.ec2.stop_instances(instance_ids=chunk)
             except Exception as e:
-                print "Failed to issue stop command for {0}".format(instance.id)
+                print "Failed to issue stop command for {0}".format(", ".join(chunk))
                 print e
 
-        while status == 0:
-            time.sleep(10)
-            for instance_id in instance_ids:
-                reservations = self.ec2.get_all_instances(instance_ids=[instance_id])
-                instance = reservations[0].instances[0]
-                if instance.update() == 'stopped':
-                    print instance_id + " stopped."
-                    instance_ids.remove(instance_id)
-                    stopped.append((instance_id))
+        for build in builds:
+            self.transition(build, 'stopping')
+            build.deadline = time.time() + self.threshold
 
-            if not instance_ids:
-                status=1
+    def stop_reservations(self, reservation_ids):
+        """
+        Tags and stops every instance in the supplied reservations. Used as a cleanup measure for failed builds so
+        they can be inspected.
+        :param reservation_ids: List of reservation ids.
+        """
+        try:
+            reservations = self.ec2.get_all_reservations(filters={'reservation-id': reservation_ids})
+        except Exception as e:
+            print "Failed to get instance reservations."
+            print e
+            return
 
-        return stopped
+        instance_ids = [instance.id for r in reservations for instance in r.instances]
+        for i in range(0, len(instance_ids), ec2_chunk):
+            chunk = instance_ids[i:i + ec2_chunk]
+            try:
+                self.ec2.create_tags(chunk, {"Name": "chef-autobuild"})
+                self.ec2.stop_instances(instance_ids=chunk)
+            except Exception as e:
+                print "Failed to stop failed build instances {0}".format(", ".join(chunk))
+                print e
+
+    def terminate_reservations(self, reservation_ids):
+        """
+        Terminates every instance in the supplied reservations.
+        :param reservation_ids: List of reservation ids.
+        """
+        try:
+            reservations = self.ec2.get_all_reservations(filters={'reservation-id': reservation_ids})
+        except Exception as e:
+            say("Failed to get instance reservations.")
+            say(str(e))
+            return
+
+        instance_ids = [instance.id for r in reservations for instance in r.instances]
+        for i in range(0, len(instance_ids), ec2_chunk):
+            self.terminate(instance_ids[i:i + ec2_chunk])
 
     def build_list(self):
         """
@@ -122,43 +1074,48 @@ class asg(object):
         print "Identifying autoscale clusters"
         print "-------------------------------"
 
-        for name, item in self.bag.iteritems():
-            for row in chef.Search('node', 'cluster:' + name + " AND chef_environment:prod NOT cluster:splunk"):
-                node = chef.Node(row.object.name)
-                str = node['ec2']['userdata']
-
-                if str is not None and len(str) > 0:
-                    pos = str.find('CLOUD_STACK=autoscale')
-                    if pos >= 1:
-                        roles = node['roles'][0]
-                        if len(node['roles']) == 3:
-                            for role in node['roles']:
-                                if role != "base" and role != "lamp-afs":
-                                    roles = role
-                                    break
-                        elif len(node['roles']) == 2:
-                            for role in node['roles']:
-                                if role != "base" and role != "lamp":
-                                    roles = role
-                                    break
-
-                        print "{0}".format(name)
-                        cluster_data.append((name, "stage", roles, node['ec2']['security_groups']))
-                        break
+        # One paged search over every prod node. Nodes are grouped by cluster as they stream in and the first
+        # autoscale node seen for each cluster in the data bag is kept.
+        clusters = self.bag.keys()
+        names = set(clusters)
+        found = {}
+        for node in self.search_nodes("chef_environment:prod NOT cluster:splunk"):
+            name = node['cluster']
+            if name not in names or name in found:
+                continue
+
+            str = node['userdata']
+
+            if str is not None and len(str) > 0:
+                pos = str.find('CLOUD_STACK=autoscale')
+                if pos >= 1:
+                    roles = node['roles'][0]
+                    if len(node['roles']) == 3:
+                        for role in node['roles']:
+                            if role != "base" and role != "lamp-afs":
+                                roles = role
+                                break
+                    elif len(node['roles']) == 2:
+                        for role in node['roles']:
+                            if role != "base" and role != "lamp":
+                                roles = role
+                                break
+
+                    found[name] = (name, "stage", roles, node['security_groups'])
+
+        for name in clusters:
+            if name in found:
+                print "{0}".format(name)
+                cluster_data.append(found[name])
 
         return cluster_data
 
-    def build_servers(self, cluster_data):
+    def build_servers(self, builds):
         """
-        Bootstraps and builds autoscaling servers to be used for AMI imaging.
-        :param cluster_data: List of the following format: [(name,env,roles,securityGroups),]
+        Bootstraps and builds autoscaling servers to be used for AMI imaging and moves them to the building state.
+        :param builds: List of queued cluster_build objects.
         """
 
-        reservation_ids = []
-        instance_ids = []
-        status = 0
-        now = time.time()
-        timelimit = now + self.threshold
         map = BlockDeviceMapping()
         eph0 = BlockDeviceType()
         eph1 = BlockDeviceType()
@@ -167,100 +1124,307 @@ class asg(object):
         map['/dev/sdb'] = eph0
         map['/dev/sdc'] = eph1
 
-        print "-------------------------------"
-        print "Launching Chef builds"
-        print "-------------------------------"
-
-        for cluster, env, role, securityGroups in cluster_data:
-            time.sleep(1)
-            userData = 'HOSTNAME=chef-autobuild01 ENV=stage CLUSTER=' + cluster + ' AUTOSCALE=1 AUTOBUILD=1 ROLES=' + role
+        for build in builds:
+            userData = 'HOSTNAME=chef-autobuild01 ENV=stage CLUSTER=' + build.name + ' AUTOSCALE=1 AUTOBUILD=1 ROLES=' + build.role
 
+            build.launch_attempts += 1
             try:
-                reservation = self.ec2.run_instances(image_id=imageId, key_name='ffe-ec2', security_groups=securityGroups,
+                reservation = self.ec2.run_instances(image_id=imageId, key_name='ffe-ec2', security_groups=build.security_groups,
                                             instance_type='c3.xlarge', user_data=userData, block_device_map=map)
-                print "Launched " + reservation.id
-                reservation_ids.append((reservation.id))
+                print "Launched " + reservation.id + " for " + build.name
+                build.reservation_id = reservation.id
+                self.transition(build, 'building')
+                build.deadline = time.time() + self.threshold
             except Exception as e:
-                print "Failed to launch instance for cluster: {0}".format(cluster)
+                code = getattr(e, 'error_code', None)
+                if code in capacity_codes and build.launch_attempts < launch_attempts:
+                    # Capacity comes back on the scale of minutes, not seconds. Leave the cluster queued.
+                    delay = random.uniform(0.5, 1.0) * min(300, 15 * 2 ** build.launch_attempts)
+                    build.not_before = time.time() + delay
+                    print "Launch for {0} returned {1}, retrying in {2:.0f}s".format(build.name, code, delay)
+                    self.metrics.retry('ec2', 'run_instances', code)
+                    continue
+                print "Failed to launch instance for cluster: {0}".format(build.name)
                 print e
+                self.transition(build, 'failed')
 
-        print "-------------------------------"
-        print "Waiting for builds to complete"
-        print "-------------------------------"
-        while status == 0:
-            time.sleep(10)
+    def create_images(self, builds):
+        """
+        Issues create_image concurrently for the stopped instances of the supplied clusters and moves them to the
+        imaging state. If an image of this run already exists for a cluster (create_image went out before an
+        interrupted run could journal it), that image is adopted instead.
+        :param builds: List of cluster_build objects whose instance has stopped.
+        """
 
-            if time.time() >= timelimit:
-                for r_id in reservation_ids:
-                    reservation_ids.remove(r_id)
-                    failed_ids.append(r_id)
+        def image(build):
+            name = build.name + "-autoscale-" + self.timestamp
+            try:
+                try:
+                    build.ami_id = self.ec2.create_image(build.instance_id, name)
+                except Exception as e:
+                    if getattr(e, 'error_code', None) != 'InvalidAMIName.Duplicate':
+                        raise
+                    existing = self.ec2.get_all_images(owners=['self'], filters={'name': name})
+                    if not existing:
+                        raise
+                    build.ami_id = existing[0].id
+                    say("Re-attached to existing image {0} for {1}".format(build.ami_id, build.name))
+                self.transition(build, 'imaging')
+                build.deadline = time.time() + self.threshold
+                say(build.instance_id + " => " + build.ami_id)
+            except Exception as e:
+                say("Failed to issue create_image for {0}".format(build.instance_id))
+                say(str(e))
+                self.fail(build, build.instance_id)
+                return
 
-            for r_id in reservation_ids:
-                for row in chef.Search('node', 'ec2_reservation_id:' + r_id + " AND chef_environment:stage", 1):
-                    node = chef.Node(row.object.name)
-                    if node is not None and len(row) > 0:
-                        print node['ec2']['instance_id'] + " => " + node['cluster']
-                        reservation_ids.remove(r_id)
-                        instance_ids.append((node['ec2']['instance_id']))
+            if build.fingerprint:
+                try:
+                    self.ec2.create_tags([build.ami_id], {fingerprint_tag: build.fingerprint})
+                except Exception as e:
+                    say("Failed to tag {0} with its fingerprint".format(build.ami_id))
+                    say(str(e))
 
-            if not reservation_ids:
-                status=1
+        if not builds:
+            return
 
-        return instance_ids
+        pool = ThreadPool(min(self.workers, len(builds)))
+        try:
+            pool.map(image, builds)
+        finally:
+            pool.close()
+            pool.join()
 
-    def create_images(self, stopped):
+    def terminate_builds(self, builds):
         """
-        Creates AMI images for the specified instances.
-        :param stopped: List of instances in the stopped state.
+        Terminates the build instances of clusters whose image is available, in one batched call, and marks them done.
+        :param builds: List of cluster_build objects whose image is available.
         """
+        for i in range(0, len(builds), ec2_chunk):
+            chunk = builds[i:i + ec2_chunk]
+            terminated = self.terminate([build.instance_id for build in chunk])
+            for build in chunk:
+                self.transition(build, 'done')
+                build.terminated = terminated
 
-        completed = []
-        ami_ids = []
-        status = 0
-        now = time.time()
-        timelimit = now + self.threshold
+    def transition(self, build, state):
+        """
+        Moves a cluster to a new state and records the phase boundary.
+        """
+        build.state = state
+        if state in finished_states:
+            self.metrics.end(build.name)
+        else:
+            self.metrics.begin(build.name, state)
+
+    def fail(self, build, failed_id):
+        """
+        Marks a cluster build as failed and records the id it failed on.
+        """
+        say("{0} failed ({1})".format(build.name, failed_id))
+        self.transition(build, 'failed')
+        failed_ids.append(failed_id)
+
+    def checkpoint(self, builds):
+        """
+        Writes the current state of every cluster to the journal, if one is configured.
+        """
+        if self.journal:
+            try:
+                self.journal.save(self.timestamp, builds)
+            except Exception as e:
+                print "Failed to write journal {0}".format(self.journal.path)
+                print e
+        if self.leases:
+            self.leases.renew()
+
+    def poll_builds(self, reservation_ids):
+        """
+        Waiter poll for the building state. Completed builds map to their Chef node.
+        """
+        return self.find_nodes('reservation_id', reservation_ids), set()
+
+    def poll_instances(self, instance_ids):
+        """
+        Waiter poll for the stopping state.
+        """
+        states = dict((instance.id, instance.state) for instance in self.get_instances(instance_ids))
+        return dict((i, True) for i in instance_ids if states.get(i) == 'stopped'), set()
+
+    def poll_images(self, ami_ids):
+        """
+        Waiter poll for the imaging state.
+        """
+        states = dict((image.id, image.state) for image in self.get_images(ami_ids))
+        return (dict((ami, True) for ami in ami_ids if states.get(ami) == 'available'),
+                set(ami for ami in ami_ids if states.get(ami) == 'failed'))
+
+    def run(self, builds, concurrency=20):
+        """
+        Moves every cluster through its own build -> stop -> image -> terminate pipeline. Up to `concurrency` clusters
+        are in flight at once. Each state has a waiter that polls all of its clusters with one batched call and
+        adapts its interval, so a cluster that converges quickly is imaged and torn down while slower ones are still
+        building.
+        Clusters already in flight (from a resumed journal) are re-attached; done and failed clusters are skipped.
+        When self.leases is set, a cluster is only launched or re-attached once this worker holds its lease. Clusters
+        held by other live workers are retried until they finish or their lease expires, in which case this worker
+        takes them over.
+        :param builds: List of cluster_build objects.
+        :param concurrency: Maximum number of clusters in flight.
+        :return: List of cluster_build objects.
+        """
+        queued = [build for build in builds if build.state == 'queued']
+        active = []
+        # Clusters held by another worker, retried every `retry` seconds.
+        waiting = []
+        retry = self.leases.ttl / 6.0 if self.leases else 0
+        retry_at = time.time() + retry
+
+        building = waiter('build', self.poll_builds, stats=self.metrics, expected=600)
+        stopping = waiter('stop', self.poll_instances, stats=self.metrics, expected=60)
+        imaging = waiter('image', self.poll_images, stats=self.metrics, expected=300)
+        waiters = {'building': (building, 'reservation_id'), 'stopping': (stopping, 'instance_id'),
+                   'imaging': (imaging, 'ami_id')}
+
+        def attach(build):
+            self.metrics.begin(build.name, build.state)
+            pending, key = waiters[build.state]
+            pending.add(getattr(build, key), build, build.deadline)
+            active.append(build)
+
+        def claim(build):
+            """
+            Returns True if this worker may work on the cluster; otherwise parks or retires it.
+            """
+            if not self.leases:
+                return True
+            state = build.state
+            outcome = self.leases.claim(build)
+            if outcome == 'claimed':
+                if build.state != state:
+                    # Adopted an in-flight cluster from a dead worker.
+                    build.deadline = time.time() + self.threshold
+                return True
+            if outcome == 'held':
+                waiting.append(build)
+            else:
+                build.state = 'remote'
+            return False
+
+        for build in builds:
+            if build.state in waiters and claim(build):
+                attach(build)
+        self.checkpoint(builds)
 
         print "-------------------------------"
-        print "Starting AMI imaging..."
+        print "Running cluster pipelines"
         print "-------------------------------"
 
-        timestamp = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-        for instance_id in stopped:
-            for row in chef.Search('node', 'ec2_instance_id:' + instance_id + " AND chef_environment:stage", 1):
-                time.sleep(1)
-                node = chef.Node(row.object.name)
-                if node is not None and len(row) > 0:
-                    try:
-                        ami = self.ec2.create_image(instance_id.encode('ascii'),node['cluster'] + "-autoscale-" + timestamp)
-                        ami_ids.append((ami, node['cluster']))
-                    except Exception as e:
-                        print "Failed to issue create_image for {0}".format(instance_id)
-                        print e
-
-        while status == 0:
-            for ami, cluster in ami_ids:
-                time.sleep(5)
-                ami_status = self.ec2.get_image(ami.encode('ascii'))
-                ami_status.update
-                if ami_status.state == 'available':
-                    print ami + " completed."
-                    completed.append((ami, cluster))
-                    ami_ids.remove((ami, cluster))
-
-            if time.time() >= timelimit:
-                for ami, cluster in ami_ids:
-                    ami_ids.remove((ami, cluster))
-                    failed_ids.append(ami)
-
-            if not ami_ids:
-                status=1
-
-        return completed
+        while queued or active or waiting:
+            if waiting and time.time() >= retry_at:
+                queued.extend(waiting)
+                del waiting[:]
+                retry_at = time.time() + retry
+
+            launching = []
+            now = time.time()
+            for build in [build for build in queued if (build.not_before or 0) <= now]:
+                if len(active) + len(launching) >= concurrency:
+                    break
+                queued.remove(build)
+                if not claim(build):
+                    continue
+                if build.state == 'queued':
+                    launching.append(build)
+                else:
+                    attach(build)
+            if launching and self.leases:
+                # Last check before spending an instance on the cluster.
+                for build in [build for build in launching if not self.leases.confirm(build)]:
+                    say("{0}: lease taken by another worker, not launching".format(build.name))
+                    launching.remove(build)
+                    build.state = 'remote'
+            if launching:
+                self.build_servers(launching)
+                for build in launching:
+                    if build.state == 'building':
+                        active.append(build)
+                        building.add(build.reservation_id, build, build.deadline)
+                    elif build.state == 'queued':
+                        # Out of capacity; retried once not_before passes.
+                        queued.append(build)
+            self.checkpoint(builds)
+
+            pending = [w for w, key in waiters.values() if w.pending]
+            wakes = [w.next_poll for w in pending]
+            if waiting:
+                wakes.append(retry_at)
+            if queued and len(active) < concurrency:
+                wakes.append(min(build.not_before or 0 for build in queued))
+            if wakes:
+                time.sleep(max(0, min(wakes) - time.time()))
+            if not pending:
+                active = [build for build in active if build.state not in finished_states]
+                continue
+
+            if building.due():
+                completed, failed, timed_out = building.check()
+                ready = []
+                for build, node in completed:
+                    build.instance_id = node['instance_id'].encode('ascii')
+                    build.node_name = node['name']
+                    print build.instance_id + " => " + build.name
+                    ready.append(build)
+                for build in timed_out:
+                    self.fail(build, build.reservation_id)
+
+                self.stop_servers(ready)
+                for build in ready:
+                    stopping.add(build.instance_id, build, build.deadline)
+                if timed_out:
+                    self.stop_reservations([build.reservation_id for build in timed_out])
+
+            if stopping.due():
+                completed, failed, timed_out = stopping.check()
+                for build in timed_out:
+                    self.fail(build, build.instance_id)
+
+                ready = [build for build, value in completed]
+                self.create_images(ready)
+                for build in ready:
+                    if build.state == 'imaging':
+                        imaging.add(build.ami_id, build, build.deadline)
+                self.checkpoint(builds)
+
+            if imaging.due():
+                completed, failed, timed_out = imaging.check()
+                for build in failed + timed_out:
+                    self.fail(build, build.ami_id)
+
+                self.terminate_builds([build for build, value in completed])
+
+            for build, adopted in self.leases.take_lost() if self.leases else []:
+                # Another worker took this cluster over; stop driving it.
+                if build.state in waiters:
+                    pending, key = waiters[build.state]
+                    pending.remove(getattr(build, key))
+                if build.reservation_id and not adopted:
+                    # The new owner didn't carry on with our instance, so nobody else will clean it up.
+                    say("{0}: lease lost, terminating own reservation {1}".format(build.name, build.reservation_id))
+                    self.terminate_reservations([build.reservation_id])
+                    self.fail(build, build.reservation_id)
+                else:
+                    self.transition(build, 'remote')
+
+            active = [build for build in active if build.state not in finished_states]
+            self.checkpoint(builds)
+
+        return builds
 
     def terminate(self, instance_id):
         """
         Terminates the supplied instance ID.
-        :param instance_id: Instance ID to terminate.
+        :param instance_id: Instance ID, or list of instance IDs, to terminate.
         :return: True or False
         """
         try:
@@ -268,23 +1432,110 @@ class asg(object):
         except Exception as e:
             print "Failed to terminate instance id {0}".format(instance_id)
             print e
+            return False
+
+        return True
 
 def main():
-    autoscale = asg()
-    cluster_data = autoscale.build_list()
-    instance_ids = autoscale.build_servers(cluster_data)
-    terminate_ids = copy.copy(instance_ids)
-    stopped = autoscale.stop_servers(instance_ids)
-    completed = autoscale.create_images(stopped)
-    autoscale.cleanup(terminate_ids)
+    parser = argparse.ArgumentParser(description='Rebuilds and re-images every autoscale cluster.')
+    parser.add_argument('--concurrency', type=int, default=20, help='Maximum number of clusters built at once.')
+    parser.add_argument('--rate', type=float, default=5.0, help='Starting number of EC2 calls per second.')
+    parser.add_argument('--max-rate', type=float, default=20.0, help='Ceiling for the adaptive EC2 call rate.')
+    parser.add_argument('--journal', default=journal_path, help='Path of the run journal.')
+    parser.add_argument('--force', action='store_true', help='Rebuild every cluster even if its build inputs are '
+                                                             'unchanged since its last image.')
+    parser.add_argument('--report', help='Write a JSON report of phase timings and API call statistics to this path.')
+    parser.add_argument('--trace', help='Write a Chrome trace (chrome://tracing) timeline of cluster phases to this path.')
+    parser.add_argument('--resume', action='store_true', help='Resume the run recorded in the journal, re-attaching '
+                                                              'to in-flight builds and images.')
+    parser.add_argument('--leases', help='Share the rebuild with other workers through cluster leases stored in this '
+                                         'directory or s3://bucket/prefix.')
+    parser.add_argument('--worker-id', help='Lease owner id for this worker. Defaults to hostname-pid; reuse it with '
+                                            '--resume to reclaim this worker\'s leases immediately.')
+    parser.add_argument('--lease-ttl', type=int, default=600, help='Seconds a lease stays valid without a heartbeat.')
+    parser.add_argument('--run-id', help='Run the leases belong to, required with --leases. Every worker of one '
+                                         'rebuild must use the same id, and each rebuild a new one.')
+    args = vars(parser.parse_args())
+    if args['leases'] and not args['run_id']:
+        parser.error('--leases requires --run-id')
+
+    run_journal = journal(args['journal'])
+    previous = run_journal.load()
+
+    autoscale = asg(rate=args['rate'], max_rate=args['max_rate'])
+    autoscale.journal = run_journal
+
+    if args['resume']:
+        if not previous:
+            print "No journal found at {0}; nothing to resume.".format(args['journal'])
+            sys.exit(1)
+        autoscale.timestamp, builds, previous_failed = previous
+        failed_ids.extend(previous_failed)
+        print "Resuming run {0} from {1}".format(autoscale.timestamp, args['journal'])
+        for build in builds:
+            print "{0}: {1}".format(build.name, build.state)
+            # Give in-flight work a fresh deadline; the interruption shouldn't count against it.
+            if build.state in ('building', 'stopping', 'imaging'):
+                build.deadline = time.time() + autoscale.threshold
+    else:
+        if previous and any(build.state not in finished_states for build in previous[1]):
+            print "Unfinished run found in {0}. Use --resume, or remove the journal to start over.".format(args['journal'])
+            sys.exit(1)
+        autoscale.metrics.begin('run', 'discovery')
+        builds = [cluster_build(*data) for data in autoscale.build_list()]
+        autoscale.metrics.begin('run', 'fingerprint')
+        autoscale.fingerprint_builds(builds, skip=not args['force'])
+
+    if args['leases']:
+        run_id = args['run_id']
+        if args['leases'].startswith('s3://'):
+            bucket, _, prefix = args['leases'][5:].partition('/')
+            store = s3_leases(bucket, (prefix or 'mass-asg-rebuild/leases').strip('/') + '/' + run_id)
+        else:
+            store = file_leases(os.path.join(args['leases'], run_id))
+        autoscale.leases = lease_manager(store, owner=args['worker_id'], ttl=args['lease_ttl'])
+        print "Sharing clusters of run {0} as worker {1} through {2}".format(run_id, autoscale.leases.owner,
+                                                                          args['leases'])
+        autoscale.leases.start()
+
+    autoscale.metrics.begin('run', 'pipeline')
+    builds = autoscale.run(builds, concurrency=args['concurrency'])
+    if autoscale.leases:
+        autoscale.leases.stop()
+    autoscale.metrics.begin('run', 'cleanup')
+    autoscale.cleanup(builds)
+    autoscale.metrics.end('run')
+
+    if args['report']:
+        autoscale.metrics.write_report(args['report'])
+        print "Wrote report to {0}".format(args['report'])
+    if args['trace']:
+        autoscale.metrics.write_trace(args['trace'])
+        print "Wrote trace to {0}".format(args['trace'])
 
     print "Run complete."
     print "SUMMARY:"
     print "-------------------------------"
     print "     AMI => CLUSTER            "
     print "-------------------------------"
-    for ami, cluster in completed:
-        print ami + " => " + cluster
+    for build in builds:
+        if build.state == 'done':
+            print build.ami_id + " => " + build.name
+
+    print "-------------------------------"
+    print "UNCHANGED (SKIPPED)"
+    print "-------------------------------"
+    for build in builds:
+        if build.state == 'skipped':
+            print build.ami_id + " => " + build.name
+
+    if autoscale.leases:
+        print "-------------------------------"
+        print "BUILT BY OTHER WORKERS"
+        print "-------------------------------"
+        for build in builds:
+            if build.state == 'remote':
+                print build.name
 
     print "-------------------------------"
     print "FAILED BUILDS/AMIS"